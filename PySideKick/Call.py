@@ -10,27 +10,198 @@ This module defines a collection of helpers for managing function calls in
 cooperation with the Qt event loop.  We have:
 
     * qCallAfter:   call function after current event has been processed
+    * qCallWhenIdle:   call function when the event loop is otherwise idle
     * qCallLater:   call function after sleeping for some interval
     * qCallInMainThread:   (blockingly) call function in the main GUI thread
+    * qCallManyInMainThread:   (blockingly) call several functions in one go
+    * qCallInThread:   (nonblockingly) call function in any QThread's loop
+    * qCallInThreadAndWait:   (blockingly) call function in any QThread's loop
     * qCallInWorkerThread:   (nonblockingly) call function in worker thread
+    * qCallInWorkerProcess:   (nonblockingly) call function in worker process
+    * qStreamInWorkerThread:   stream items from worker thread to main thread
+    * qParallelMap:   map function over an iterable using worker threads
+
+
+Functions executed in another thread produce a Future object, which can be
+used to wait for the result or to register a completion callback.  To wait
+for several futures at once, use:
+
+    * wait_any(futures):  wait for at least one of the futures to complete
+    * wait_all(futures):  wait for all of the futures to complete
+
+
+Worker threads are managed by a WorkerPool, which can be tuned or replaced
+by a separately-named pool for particular kinds of work:
+
+    * qWorkerPool(name):  get (or create) the named pool of worker threads
+    * qSerialQueue(name):  get (or create) a named queue of calls that are
+                           run in a worker thread one at a time, in order
+    * TaskGroup():  a group of worker tasks that succeed or fail together
+
+Tasks submitted with WorkerPool.submit_task() can be cancelled or given a
+deadline, and should cooperate by checking the token returned by:
+
+    * qCurrentCancelToken():  get the CancelToken for the current task
 
 
 There is also a decorator to apply these helpers to all calls to a function:
 
     * qCallUsing(helper):  route all calls to a function through the helper
 
+
+The following helpers collapse redundant calls before they reach the main
+thread, and are designed for use with qCallUsing:
+
+    * qCoalesce():  replace a pending call with the newest arguments
+    * qDebounce(interval):  call only once calls stop for 'interval' secs
+    * qThrottle(rate):  call at most 'rate' times per second
+
+There's also a helper to avoid repeating expensive calls altogether:
+
+    * qCached(maxsize,ttl):  share results of identical calls via a cache
+
+
+To find out where time is being spent, you can collect statistics about the
+calls made via these helpers:
+
+    * qEnableInstrumentation():  start collecting timing statistics
+    * qGetCallStats():  get summaries of queue depth, wait and run times
+
+To see how calls flow between threads, you can record a trace of them and
+view it in a trace viewer such as chrome://tracing:
+
+    * qEnableTracing():  start recording calls into a ring buffer
+    * qDumpTrace(filename):  write the recorded calls as trace-event JSON
+
 """
 
+import os
 import sys
+import math
+import time
 import thread
+import atexit
+import logging
 import threading
+import traceback
+import itertools
+import json
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 from functools import wraps
+from collections import deque, OrderedDict
 import Queue
+try:
+    import multiprocessing
+    from multiprocessing import cpu_count
+except ImportError:
+    multiprocessing = None
+    cpu_count = None
 
 import PySideKick
 from PySideKick import QtCore, qIsMainThread
 
 
+logger = logging.getLogger("PySideKick.Call")
+
+
+#  Priority lanes for functions queued via qCallAfter.
+PRIORITY_URGENT = 0
+PRIORITY_NORMAL = 1
+PRIORITY_IDLE = 2
+
+#  Policies for handling calls queued when a bounded call queue is full.
+OVERFLOW_BLOCK = "block"
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_DROP_NEWEST = "drop_newest"
+OVERFLOW_COALESCE = "coalesce"
+
+
+def _default_coalesce_key(call):
+    (func,args,kwds) = call[:3]
+    while isinstance(func,(_InstrumentedCall,_TracedCall)):
+        func = func.func
+    return (func,args,kwds)
+
+
+class _ExemptCall(tuple):
+    """Marker for queued calls that are exempt from the overflow policy."""
+    __slots__ = ()
+
+
+class _CallQueue(Queue.Queue):
+    """Queue of pending (func,args,kwds) calls, with an overflow policy.
+
+    If 'maxsize' is greater than zero, then calls queued via put_call() when
+    the queue is full are handled according to 'overflow_policy':
+
+        * OVERFLOW_BLOCK:  block until there's room in the queue.  This never
+                           happens in the main thread, since it would
+                           deadlock; the queue just grows beyond its bounds.
+        * OVERFLOW_DROP_OLDEST:  discard the oldest call in the queue
+        * OVERFLOW_DROP_NEWEST:  discard the call being queued
+        * OVERFLOW_COALESCE:  replace the queued call with the same key, as
+                              computed by 'coalesce_key'; if there isn't
+                              one, discard the oldest call in the queue
+
+    By default calls are coalesced only if they have the same function and
+    arguments.  Calls queued with exempt=True are never dropped, blocked or
+    coalesced, and may take the queue beyond its bounds.  They're used for
+    calls that something else is waiting on, such as qCallInMainThread.
+    """
+
+    def __init__(self,maxsize=0):
+        Queue.Queue.__init__(self,maxsize)
+        self.overflow_policy = OVERFLOW_BLOCK
+        self.coalesce_key = _default_coalesce_key
+        self.num_dropped = 0
+        self.num_blocked = 0
+        self.num_coalesced = 0
+
+    def put_call(self,call,exempt=False):
+        with self.not_full:
+            if exempt:
+                call = _ExemptCall(call)
+            elif 0 < self.maxsize <= self._qsize():
+                if not self._overflow(call):
+                    return
+            self._put(call)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _overflow(self,call):
+        #  This must be called while holding self.mutex.  It returns True
+        #  if the call should still be added to the queue.
+        policy = self.overflow_policy
+        if policy == OVERFLOW_BLOCK:
+            if not qIsMainThread():
+                self.num_blocked += 1
+                while self._qsize() >= self.maxsize:
+                    self.not_full.wait()
+            return True
+        if policy == OVERFLOW_DROP_NEWEST:
+            self.num_dropped += 1
+            return False
+        if policy == OVERFLOW_COALESCE:
+            key = self.coalesce_key(call)
+            for (i,queued_call) in enumerate(self.queue):
+                if isinstance(queued_call,_ExemptCall):
+                    continue
+                if self.coalesce_key(queued_call) == key:
+                    self.queue[i] = call
+                    self.num_coalesced += 1
+                    return False
+        self.num_dropped += 1
+        for (i,queued_call) in enumerate(self.queue):
+            if not isinstance(queued_call,_ExemptCall):
+                del self.queue[i]
+                return True
+        #  Everything in the queue is exempt, so drop the new call instead.
+        return False
+
+
 class qCallAfter(QtCore.QObject):
     """Call the given function on a subsequent iteration of the event loop.
 
@@ -42,33 +213,187 @@ class qCallAfter(QtCore.QObject):
     The implementation is as a singleton QObject subclass.  It maintains a
     queue of functions to the called, and posts an event to itself whenever
     a new function is queued.
+
+    Functions can be queued in one of three priority lanes using the method
+    qCallAfter.callWithPriority(priority,func,*args,**kwds):
+
+        * PRIORITY_URGENT:  run before any normal-priority functions
+        * PRIORITY_NORMAL:  the default lane used by qCallAfter(func)
+        * PRIORITY_IDLE:    run only when there are no other pending events;
+                            see also the qCallWhenIdle helper
+
+    To prevent starvation, a normal-priority function is run after every
+    'max_urgent_streak' consecutive urgent functions, and idle functions
+    that have been waiting longer than 'max_idle_delay' seconds are run even
+    if the event loop is still busy.
+
+    When lots of functions are being queued (e.g. from a busy worker thread)
+    posting an event for each one can swamp the event loop.  Call the method
+    qCallAfter.configure(batch_calls=True) to switch to batching mode, where
+    at most one wakeup event is outstanding at any time and each event runs
+    as many queued functions as it can within 'time_budget' seconds.  If it
+    runs out of time, it yields to the event loop so that paints and user
+    input can be processed before continuing.
+
+    By default each lane can grow without bound.  To stop producers from
+    flooding the main thread, call qCallAfter.configure(max_pending=N) to
+    limit each lane to N pending functions, and choose an overflow policy
+    as described in the _CallQueue class.  The stats() method reports how
+    many calls have been dropped, blocked or coalesced.
     """
  
     def __init__(self):
-        super(qCallAfter,self).__init__(None)
+        #  Note that the name "qCallAfter" will refer to the singleton
+        #  instance by the time this is called, so we can't use super().
+        QtCore.QObject.__init__(self,None)
         self.app = None
         self.event_id = QtCore.QEvent.registerEventType()
         self.event_type = QtCore.QEvent.Type(self.event_id)
+        self.idle_event_id = QtCore.QEvent.registerEventType()
+        self.idle_event_type = QtCore.QEvent.Type(self.idle_event_id)
         self.pending_func_queue = Queue.Queue()
-        self.func_queue = Queue.Queue()
+        self.urgent_func_queue = _CallQueue()
+        self.func_queue = _CallQueue()
+        self.idle_func_queue = _CallQueue()
+        self.func_queues = (self.urgent_func_queue,self.func_queue,
+                            self.idle_func_queue,)
+        self.batch_calls = False
+        self.time_budget = 0.01
+        self.max_urgent_streak = 20
+        self.max_idle_delay = 1.0
+        self._wakeup_lock = threading.Lock()
+        self._wakeup_pending = False
+        self._idle_pending = False
+        self._idle_timer = None
+        self._urgent_streak = 0
+
+    def configure(self,batch_calls=None,time_budget=None,
+                       max_urgent_streak=None,max_idle_delay=None,
+                       max_pending=None,overflow_policy=None,
+                       coalesce_key=None):
+        """Adjust the way in which queued functions are dispatched.
+
+        If 'batch_calls' is true then queued functions are run in batches,
+        with each batch taking at most 'time_budget' seconds.  If false,
+        a separate event is posted for each queued function.  See the class
+        docstring for the meaning of the other arguments.
+
+        If given, 'coalesce_key' must be a function taking a tuple
+        (func,args,kwds) and returning the key by which to coalesce calls.
+        """
+        for q in self.func_queues:
+            with q.mutex:
+                if max_pending is not None:
+                    q.maxsize = max_pending
+                    q.not_full.notify_all()
+                if overflow_policy is not None:
+                    q.overflow_policy = overflow_policy
+                if coalesce_key is not None:
+                    q.coalesce_key = coalesce_key
+        if time_budget is not None:
+            self.time_budget = time_budget
+        if max_urgent_streak is not None:
+            self.max_urgent_streak = max_urgent_streak
+        if max_idle_delay is not None:
+            self.max_idle_delay = max_idle_delay
+        if batch_calls is not None and batch_calls != self.batch_calls:
+            self.batch_calls = batch_calls
+            if self.app is not None:
+                #  Make sure there's an event for each function that was
+                #  queued under the previous mode.
+                if batch_calls:
+                    self._wakeup()
+                else:
+                    num_calls = self.urgent_func_queue.qsize()
+                    num_calls += self.func_queue.qsize()
+                    for _ in xrange(num_calls):
+                        self._postEvent()
+
+    def _copyConfig(self,other):
+        self.batch_calls = other.batch_calls
+        self.time_budget = other.time_budget
+        self.max_urgent_streak = other.max_urgent_streak
+        self.max_idle_delay = other.max_idle_delay
+        for (q,other_q) in zip(self.func_queues,other.func_queues):
+            q.maxsize = other_q.maxsize
+            q.overflow_policy = other_q.overflow_policy
+            q.coalesce_key = other_q.coalesce_key
+
+    def numPending(self):
+        """Get the number of functions waiting to be called."""
+        return sum(q.qsize() for q in self.func_queues)
+
+    def stats(self):
+        """Get a dict of statistics about calls queued via qCallAfter.
+
+        This reports the number of calls currently pending, and how many
+        calls have been dropped, blocked or coalesced due to overflow.
+        """
+        stats = {"pending":0,"dropped":0,"blocked":0,"coalesced":0}
+        for q in self.func_queues:
+            stats["pending"] += q.qsize()
+            stats["dropped"] += q.num_dropped
+            stats["blocked"] += q.num_blocked
+            stats["coalesced"] += q.num_coalesced
+        return stats
  
     def customEvent(self,event):
         if event.type() == self.event_type:
-            self._popCall()
+            if self.batch_calls:
+                self._drainCalls()
+            else:
+                try:
+                    self._popCall()
+                except Queue.Empty:
+                    pass
+        elif event.type() == self.idle_event_type:
+            if self._idle_timer is None:
+                self._idle_timer = QtCore.QTimer()
+                self._idle_timer.setSingleShot(True)
+                self._idle_timer.timeout.connect(self._runIdleCalls)
+            #  A zero-interval timer fires once the event queue is empty.
+            self._idle_timer.start(0)
 
     def __call__(self,func,*args,**kwds):
+        self.callWithPriority(PRIORITY_NORMAL,func,*args,**kwds)
+
+    def callWithPriority(self,priority,func,*args,**kwds):
+        """Call the given function after the current event, with priority.
+
+        The 'priority' argument must be one of PRIORITY_URGENT,
+        PRIORITY_NORMAL or PRIORITY_IDLE.
+        """
+        self._queueCall(priority,func,args,kwds,False)
+
+    def _queueCall(self,priority,func,args,kwds,exempt):
         global qCallAfter
         #  If the app is running, dispatch the event directly.
         if self.app is not None:
-            self.func_queue.put((func,args,kwds))
-            self._postEvent()
+            instrumentation = _instrumentation
+            if instrumentation is not None:
+                func = instrumentation.wrap_call("qCallAfter",func)
+            if _tracer is not None:
+                func = _tracer.wrap_call("qCallAfter",func)
+            if priority == PRIORITY_NORMAL:
+                self.func_queue.put_call((func,args,kwds),exempt)
+            elif priority == PRIORITY_URGENT:
+                self.urgent_func_queue.put_call((func,args,kwds),exempt)
+            else:
+                self.idle_func_queue.put_call((func,args,kwds,time.time()),
+                                              exempt)
+            if instrumentation is not None:
+                instrumentation.record_depth("qCallAfter",self.numPending())
+            if priority == PRIORITY_IDLE:
+                self._wakeupIdle()
+            else:
+                self._wakeup()
             return
         #  Otherwise, we have some bootstrapping to do!
         #  Before dispatching, there must be a running app and we must
         #  be on the same thread as it.
         app = QtCore.QCoreApplication.instance()
         if app is None or not qIsMainThread():
-            self.pending_func_queue.put((func,args,kwds))
+            self.pending_func_queue.put((priority,func,args,kwds,exempt))
             return
         #  This is the first call with a running app and from the 
         #  main thread.  If it turns out we're not on the main thread,
@@ -76,6 +401,7 @@ class qCallAfter(QtCore.QObject):
         if hasattr(self,"thread"):
             if self.thread() is not QtCore.QThread.currentThread():
                 qCallAfter = self.__class__()
+                qCallAfter._copyConfig(self)
             else:
                 self.app = app
         else:
@@ -84,28 +410,121 @@ class qCallAfter(QtCore.QObject):
         #  Flush all pending events.
         try:
             while True:
-                (pfunc,pargs,pkwds) = self.pending_func_queue.get(False)
-                qCallAfter(pfunc,*pargs,**pkwds)
+                pcall = self.pending_func_queue.get(False)
+                qCallAfter._queueCall(*pcall)
         except Queue.Empty:
             pass
-        qCallAfter(func,*args,**kwds)
+        qCallAfter._queueCall(priority,func,args,kwds,exempt)
 
     def _popCall(self):
-        (func,args,kwds) = self.func_queue.get(False)
+        #  Take from the urgent lane, unless the normal lane is being starved.
+        if self._urgent_streak < self.max_urgent_streak:
+            try:
+                (func,args,kwds) = self.urgent_func_queue.get(False)
+            except Queue.Empty:
+                self._urgent_streak = 0
+            else:
+                self._urgent_streak += 1
+                func(*args,**kwds)
+                return
+        try:
+            (func,args,kwds) = self.func_queue.get(False)
+        except Queue.Empty:
+            (func,args,kwds) = self.urgent_func_queue.get(False)
+        else:
+            self._urgent_streak = 0
         func(*args,**kwds)
 
-    def _postEvent(self):
-        event = QtCore.QEvent(self.event_type)
+    def _hasCalls(self):
+        if not self.func_queue.empty():
+            return True
+        if not self.urgent_func_queue.empty():
+            return True
+        return False
+
+    def _drainCalls(self):
+        #  Clear the wakeup flag before running anything, so that functions
+        #  queued while we're draining (e.g. from within a nested event loop)
+        #  will post a fresh wakeup event rather than waiting for us.
+        with self._wakeup_lock:
+            self._wakeup_pending = False
+        deadline = time.time() + self.time_budget
+        exhausted = False
+        try:
+            while True:
+                self._popCall()
+                if time.time() >= deadline:
+                    break
+        except Queue.Empty:
+            exhausted = True
+        finally:
+            #  If we ran out of time (or a function raised an error) then
+            #  yield to the event loop and continue on a later iteration.
+            if not exhausted and self._hasCalls():
+                self._wakeup()
+
+    def _runIdleCalls(self):
+        with self._wakeup_lock:
+            self._idle_pending = False
+        idle_func_queue = self.idle_func_queue
+        deadline = time.time() + self.time_budget
+        try:
+            while not idle_func_queue.empty():
+                #  Leave the call in the queue if there are other events to
+                #  process, unless it has been waiting for too long.
+                #  We're the only consumer, so it's safe to peek at the head.
+                queued_at = idle_func_queue.queue[0][3]
+                if self.app.hasPendingEvents():
+                    if time.time() - queued_at < self.max_idle_delay:
+                        break
+                (func,args,kwds,_) = idle_func_queue.get(False)
+                func(*args,**kwds)
+                if time.time() >= deadline:
+                    break
+        finally:
+            if not idle_func_queue.empty():
+                with self._wakeup_lock:
+                    self._idle_pending = True
+                self._idle_timer.start(0)
+
+    def _wakeup(self):
+        if self.batch_calls:
+            with self._wakeup_lock:
+                if self._wakeup_pending:
+                    return
+                self._wakeup_pending = True
+        self._postEvent()
+
+    def _wakeupIdle(self):
+        with self._wakeup_lock:
+            if self._idle_pending:
+                return
+            self._idle_pending = True
+        self._postEvent(self.idle_event_type)
+
+    def _postEvent(self,event_type=None):
+        if event_type is None:
+            event_type = self.event_type
+        event = QtCore.QEvent(event_type)
         try:
             self.app.postEvent(self,event)
         except RuntimeError:
             #  This can happen if the app has been destroyed.
             #  Immediately empty the queue.
+            with self._wakeup_lock:
+                self._wakeup_pending = False
+                self._idle_pending = False
             try:
                 while True:
                     self._popCall()
             except Queue.Empty:
                 pass
+            try:
+                while True:
+                    (func,args,kwds,_) = self.idle_func_queue.get(False)
+                    func(*args,**kwds)
+            except Queue.Empty:
+                pass
 
 #  Optimistically create the singleton instance of qCallAfter.
 #  If this module is imported from a non-gui thread then this instance will
@@ -113,6 +532,51 @@ class qCallAfter(QtCore.QObject):
 qCallAfter = qCallAfter()
 
 
+def _call_after_exempt(func,*args,**kwds):
+    """Call the given function after the current event, without fail.
+
+    This is like qCallAfter, but the call is exempt from the overflow policy
+    of a bounded call queue.  It's for use by helpers whose callers would
+    otherwise wait forever if the call were dropped or coalesced.
+    """
+    qCallAfter._queueCall(PRIORITY_NORMAL,func,args,kwds,True)
+
+
+def qCallWhenIdle(func,*args,**kwds):
+    """Call the given function once the event loop is idle.
+
+    This helper is like qCallAfter, but the function will only be called
+    once there are no other events waiting to be processed.  It's useful for
+    background bookkeeping that shouldn't interfere with responsiveness to
+    user input.  Functions that have been waiting for longer than
+    qCallAfter.max_idle_delay seconds will be called regardless.
+    """
+    qCallAfter.callWithPriority(PRIORITY_IDLE,func,*args,**kwds)
+
+
+
+#  Use the standard exception classes from concurrent.futures if available,
+#  so that our Future objects can stand in for the standard ones.
+try:
+    from concurrent.futures import CancelledError, TimeoutError
+except ImportError:
+    class CancelledError(Exception):
+        """The Future was cancelled."""
+    class TimeoutError(Exception):
+        """The operation exceeded the given deadline."""
+
+
+class StaleFutureError(RuntimeError):
+    """A Future was used after being recycled."""
+
+
+#  Possible states of a Future object.
+PENDING = "PENDING"
+RUNNING = "RUNNING"
+CANCELLED = "CANCELLED"
+CANCELLED_AND_NOTIFIED = "CANCELLED_AND_NOTIFIED"
+FINISHED = "FINISHED"
+
 
 class Future(object):
     """Primative "future" class for executing functions in another thread.
@@ -121,52 +585,324 @@ class Future(object):
     Call the "get_result" method to wait until completion and get the result
     (or raise the exception).
 
-    Existing Future objects are recycled to avoid the overhead of allocating
-    a new lock primitive for each async call.
+    This class implements the same interface as concurrent.futures.Future,
+    so you can also use result(timeout), exception(timeout), cancel() and
+    friends.  To avoid polling for completion, use add_done_callback() to
+    have a function called with the future once it's done.  Pass the
+    argument in_main_thread=True to have the callback run in the main
+    thread via qCallAfter, where it can safely manipulate the GUI.
+
+    Existing Future objects can be recycled to avoid the overhead of
+    allocating a new lock primitive for each async call.  Use the classmethod
+    get_or_create() to obtain a future, and call recycle() once you're sure
+    that nobody else holds a reference to it.  Each recycling bumps the
+    future's "generation" number; a recycled future will raise StaleFutureError
+    if it is used before being handed out again, and code that might outlive
+    its reference can use check_generation() to detect that it has been
+    recycled and re-used.
+
+    A future may be associated with a CancelToken, in which case calling
+    cancel() on the future while it is running will ask the computation to
+    stop at its next convenient point.
     """
 
-    _READY_INSTANCES = []
+    __slots__ = ("_condition","_state","_result","_exc_info","_callbacks",
+                 "_waiters","_generation","_free","_token",)
+
+    #  A bounded LIFO stack of recycled instances.  Appending to and popping
+    #  from a deque are atomic operations, so we don't need a lock.
+    _FREE_LIST = deque(maxlen=256)
 
     def __init__(self):
-        self.ready = threading.Event()
-        self.result = None
-        self.exception = None
+        self._condition = threading.Condition()
+        self._state = PENDING
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._waiters = []
+        self._generation = 0
+        self._free = False
+        self._token = None
 
     @classmethod
     def get_or_create(cls):
         try:
-            return cls._READY_INSTANCES.pop(0)
+            future = cls._FREE_LIST.pop()
         except IndexError:
             return cls()
+        future._free = False
+        return future
 
     def recycle(self):
-        self.result = None
-        self.exception = None
-        self.ready.clear()
-        self._READY_INSTANCES.append(self)
+        """Reset this future and return it to the pool of free instances.
+
+        Only call this when you're certain that no other code is holding
+        a reference to the future.
+        """
+        with self._condition:
+            if self._free:
+                raise StaleFutureError("Future has already been recycled")
+            self._free = True
+            self._generation += 1
+            self._state = PENDING
+            self._result = None
+            self._exc_info = None
+            self._token = None
+            del self._callbacks[:]
+            del self._waiters[:]
+        self._FREE_LIST.append(self)
+
+    @property
+    def generation(self):
+        """Number of times this future has been recycled."""
+        return self._generation
+
+    def check_generation(self,generation):
+        """Raise StaleFutureError unless the future is still at 'generation'.
+
+        This lets code that holds on to a future (e.g. a pending call that
+        will eventually set its result) detect that it has since been
+        recycled and re-used for a different computation.
+        """
+        if self._free or generation != self._generation:
+            raise StaleFutureError("Future has been recycled")
 
     def call_function(self,func,*args,**kwds):
+        if not self.set_running_or_notify_cancel():
+            return
         try:
-            self.result = func(*args,**kwds)
+            result = func(*args,**kwds)
         except Exception:
-            self.exception = sys.exc_info()
-        finally:
-            self.ready.set()
+            self.set_exc_info(sys.exc_info())
+        else:
+            self.set_result(result)
 
-    def get_result(self):
-        self.ready.wait()
-        try:
-            if self.exception is None:
-                return self.result
-            else:
-                raise self.exception[0], \
-                      self.exception[1], \
-                      self.exception[2]
-        finally:
-            self.recycle()
+    def call_function_if_current(self,generation,func,*args,**kwds):
+        """Like call_function, but only if still at the given generation."""
+        self.check_generation(generation)
+        self.call_function(func,*args,**kwds)
+
+    def get_result(self,timeout=None):
+        return self.result(timeout)
 
     def is_ready(self):
-        return self.read.isSet()
+        return self.done()
+
+    @property
+    def token(self):
+        """The CancelToken associated with this future, or None."""
+        return self._token
+
+    def cancel(self):
+        """Cancel the future if possible.
+
+        Returns True if the future was cancelled, False if it is already
+        running or has finished.  If it is running and has an associated
+        CancelToken, the token is cancelled so that the computation can
+        stop early.
+        """
+        with self._condition:
+            if self._state == RUNNING and self._token is not None:
+                self._token.cancel()
+            if self._state in (RUNNING,FINISHED):
+                return False
+            if self._state in (CANCELLED,CANCELLED_AND_NOTIFIED):
+                return True
+            self._state = CANCELLED
+            self._condition.notify_all()
+        self._invoke_callbacks()
+        return True
+
+    def cancelled(self):
+        """Check whether the future was cancelled."""
+        return self._state in (CANCELLED,CANCELLED_AND_NOTIFIED)
+
+    def running(self):
+        """Check whether the future is currently executing."""
+        return self._state == RUNNING
+
+    def done(self):
+        """Check whether the future was cancelled or finished executing."""
+        return self._state in (CANCELLED,CANCELLED_AND_NOTIFIED,FINISHED)
+
+    def result(self,timeout=None):
+        """Get the result of the computation.
+
+        This method blocks for at most 'timeout' seconds waiting for the
+        computation to complete, raising TimeoutError if it doesn't.  If
+        the computation raised an exception, it is re-raised here.
+        """
+        self._wait(timeout)
+        if self._exc_info is None:
+            return self._result
+        raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+    def exception(self,timeout=None):
+        """Get the exception raised by the computation, or None."""
+        self._wait(timeout)
+        if self._exc_info is None:
+            return None
+        return self._exc_info[1]
+
+    def add_done_callback(self,fn,in_main_thread=False):
+        """Arrange for fn(future) to be called when the future is done.
+
+        If the future is already done then the callback is invoked
+        immediately.  Otherwise it is invoked by whichever thread completes
+        the future, unless 'in_main_thread' is true in which case it is
+        always invoked in the main thread via qCallAfter.
+        """
+        with self._condition:
+            self._check_not_free()
+            if not self.done():
+                self._callbacks.append((fn,in_main_thread))
+                return
+        self._invoke_callback(fn,in_main_thread)
+
+    def set_running_or_notify_cancel(self):
+        """Mark the future as running, unless it has been cancelled.
+
+        Returns False if the future was cancelled, True otherwise.  This is
+        intended for use by executors, not by client code.
+        """
+        with self._condition:
+            self._check_not_free()
+            if self._state == CANCELLED:
+                self._state = CANCELLED_AND_NOTIFIED
+                return False
+            if self._state == PENDING:
+                self._state = RUNNING
+                return True
+            raise RuntimeError("Future in unexpected state: " + self._state)
+
+    def set_result(self,result):
+        """Set the result of the computation and mark the future as done."""
+        with self._condition:
+            self._check_not_free()
+            self._result = result
+            self._state = FINISHED
+            self._condition.notify_all()
+        self._invoke_callbacks()
+
+    def set_exception(self,exception):
+        """Set the exception raised by the computation."""
+        self.set_exc_info((type(exception),exception,None))
+
+    def set_exc_info(self,exc_info):
+        """Set the (type,value,traceback) of the computation's exception."""
+        with self._condition:
+            self._check_not_free()
+            self._exc_info = exc_info
+            self._state = FINISHED
+            self._condition.notify_all()
+        self._invoke_callbacks()
+
+    def _check_not_free(self):
+        if self._free:
+            raise StaleFutureError("Future has been recycled")
+
+    def _wait(self,timeout):
+        with self._condition:
+            self._check_not_free()
+            if timeout is None:
+                while not self.done():
+                    self._condition.wait()
+            else:
+                end_time = time.time() + timeout
+                while not self.done():
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+            if self.cancelled():
+                raise CancelledError()
+            if not self.done():
+                raise TimeoutError()
+
+    def _invoke_callbacks(self):
+        with self._condition:
+            callbacks = self._callbacks[:]
+            del self._callbacks[:]
+            waiters = self._waiters[:]
+        for waiter in waiters:
+            waiter.add_done(self)
+        for (fn,in_main_thread) in callbacks:
+            self._invoke_callback(fn,in_main_thread)
+
+    def _invoke_callback(self,fn,in_main_thread):
+        if in_main_thread and not qIsMainThread():
+            _call_after_exempt(fn,self)
+        else:
+            try:
+                fn(self)
+            except Exception:
+                logger.exception("exception calling callback for %r",self)
+
+    def _add_waiter(self,waiter):
+        with self._condition:
+            if not self.done():
+                self._waiters.append(waiter)
+                return
+        waiter.add_done(self)
+
+    def _remove_waiter(self,waiter):
+        with self._condition:
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
+
+
+class _Waiter(object):
+    """Helper for waiting on the completion of several futures at once."""
+
+    def __init__(self,num_needed):
+        self.num_needed = num_needed
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+
+    def add_done(self,future):
+        with self.lock:
+            self.num_needed -= 1
+            if self.num_needed <= 0:
+                self.event.set()
+
+
+def _wait_for_futures(futures,timeout,num_needed):
+    futures = set(futures)
+    waiter = _Waiter(min(num_needed,len(futures)))
+    if waiter.num_needed <= 0:
+        waiter.event.set()
+    for future in futures:
+        future._add_waiter(waiter)
+    try:
+        waiter.event.wait(timeout)
+    finally:
+        for future in futures:
+            future._remove_waiter(waiter)
+    done = set(f for f in futures if f.done())
+    return (done,futures - done)
+
+
+def wait_any(futures,timeout=None):
+    """Wait for any one of the given futures to complete.
+
+    This function blocks for up to 'timeout' seconds waiting for at least
+    one of the futures to be done.  It returns a pair of sets (done,
+    not_done) just like the wait() function from concurrent.futures.
+    """
+    return _wait_for_futures(futures,timeout,1)
+
+
+def wait_all(futures,timeout=None):
+    """Wait for all the given futures to complete.
+
+    This function blocks for up to 'timeout' seconds waiting for all of
+    the futures to be done.  It returns a pair of sets (done, not_done)
+    just like the wait() function from concurrent.futures.
+    """
+    futures = list(futures)
+    return _wait_for_futures(futures,timeout,len(futures))
 
 
 def qCallInMainThread(func,*args,**kwds):
@@ -177,66 +913,1955 @@ def qCallInMainThread(func,*args,**kwds):
     call functions that manipulate the GUI from a non-GUI thread.
     """
     if qIsMainThread():
-        func(*args,**kwds)
+        return func(*args,**kwds)
     else:
+        #  The future never escapes from this function, so we can safely
+        #  recycle it once we have the result.
+        tracer = _tracer
+        if tracer is not None:
+            func = tracer.wrap_call("qCallInMainThread",func)
+            started_at = time.time()
         future = Future.get_or_create()
-        qCallAfter(future.call_function,func,*args,**kwds)
-        return future.get_result()
+        generation = future.generation
+        _call_after_exempt(future.call_function_if_current,generation,
+                           func,*args,**kwds)
+        try:
+            return future.result()
+        finally:
+            future.recycle()
+            if tracer is not None:
+                tracer.record_span("qCallInMainThread:wait",func,
+                                   started_at,time.time())
 
 
-def qCallInWorkerThread(func,*args,**kwds):
-    """Asynchronously call the given function in a background worker thread.
+#  Tell qCallUsing that it can skip the helper when in the main thread.
+qCallInMainThread.can_call_inline = qIsMainThread
 
-    This helper arranges for the given function to be executed by a background
-    worker thread.  Eventually it'll get a thread pool; for now each task
-    spawns a new background thread.
 
-    If you need to know the result of the function call, this helper returns
-    a Future object; use f.is_ready() to test whether it's ready and call
-    f.get_result() to get the return value or raise the exception.
+def _call_many(calls):
+    """Call each of the given (func,args,kwds) tuples, returning the results.
+
+    If any of the calls raises an exception, the remaining calls are skipped
+    and the exception is propagated to the caller.
     """
-    future = Future.get_or_create()
-    def runit():
-        future.call_function(func,*args,**kwds)
-    threading.Thread(target=runit).start()
-    return future
+    return [func(*args,**kwds) for (func,args,kwds) in calls]
 
 
-def qCallLater(interval,func,*args,**kwds):
-    """Asynchronously call the given function after a timeout.
+def _normalize_call(call):
+    """Convert a callable or (func,args[,kwds]) tuple into a 3-tuple."""
+    if callable(call):
+        return (call,(),{})
+    if len(call) == 2:
+        return (call[0],call[1],{})
+    return tuple(call)
 
-    This helper is similar to qCallAfter, but it waits at least 'interval'
-    seconds before executing the function.  To cancel the call before the
-    sleep interval has expired, call 'cancel' on the returned object.
 
-    Currently this is a thin wrapper around threading.Timer; eventually it
-    will be integrated with Qt's own timer mechanisms.
+def qCallManyInMainThread(calls):
+    """Synchronously call several functions in the main thread.
+
+    This helper is like qCallInMainThread, but makes a single round-trip to
+    the main thread for a whole list of calls.  Each item in the list may be
+    either a callable, or a tuple (func,args) or (func,args,kwds).  The calls
+    are made in order and a list of their results is returned.  If any call
+    raises an exception, the remaining calls are skipped and the exception
+    is re-raised in the calling thread.
     """
-    def runit():
-        qCallAfter(func,*args,**kwds)
-    t = threading.Timer(interval,runit)
-    t.start()
-    return t
+    calls = [_normalize_call(call) for call in calls]
+    if not calls:
+        return []
+    return qCallInMainThread(_call_many,calls)
 
 
-def qCallUsing(helper):
-    """Function/method decorator to always apply a function call helper.
+class qMainThreadBatch(object):
+    """Context manager to accumulate calls for the main thread.
 
-    This decorator can be used to ensure that a function is always called
-    using one of the qCall helpers.  For example, the following function can
-    be safely called from any thread, as it will transparently apply the
-    qCallInMainThread helper whenever it is called:
+    Calls added to the batch are queued up locally, then sent to the main
+    thread in a single round-trip via qCallManyInMainThread when the batch
+    is flushed.  This happens on exit from the with-statement, unless it is
+    exiting due to an exception:
 
-        @qCallUsing(qCallInMainThread)
-        def prompt_for_input(msg):
-            # ... pop up a dialog, return input
+        with qMainThreadBatch() as batch:
+            for (label,text) in zip(labels,texts):
+                batch.add(label.setText,text)
+        results = batch.results
 
+    The batch object can also be used as a helper with qCallUsing, so that
+    calls to the decorated function are added to the batch.
     """
-    def decorator(func):
-        @wraps(func)
-        def wrapper(*args,**kwds):
-            return helper(func,*args,**kwds)
-        return wrapper
-    return decorator
 
+    def __init__(self):
+        self.calls = []
+        self.results = []
+
+    def add(self,func,*args,**kwds):
+        """Add a call to the batch."""
+        self.calls.append((func,args,kwds))
+
+    __call__ = add
+
+    def flush(self):
+        """Make all the pending calls, returning a list of their results.
+
+        The results are also appended to the 'results' attribute.
+        """
+        (calls,self.calls) = (self.calls,[])
+        results = qCallManyInMainThread(calls)
+        self.results.extend(results)
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.calls = []
+        return False
+
+
+class _ThreadDispatcher(QtCore.QObject):
+    """Helper object for dispatching function calls to a particular QThread.
+
+    Each instance lives in its target thread, and runs queued functions when
+    it receives a wakeup event.  At most one wakeup event is outstanding at
+    any time, and each one runs all the functions queued so far.
+    """
+
+    event_type = None
+
+    def __init__(self,qthread):
+        QtCore.QObject.__init__(self,None)
+        if _ThreadDispatcher.event_type is None:
+            event_id = QtCore.QEvent.registerEventType()
+            _ThreadDispatcher.event_type = QtCore.QEvent.Type(event_id)
+        self.moveToThread(qthread)
+        self.calls = deque()
+        self._lock = threading.Lock()
+        self._wakeup_pending = False
+
+    def submit(self,func,args,kwds):
+        future = Future.get_or_create()
+        self.calls.append((future,func,args,kwds))
+        with self._lock:
+            if self._wakeup_pending:
+                return future
+            self._wakeup_pending = True
+        app = QtCore.QCoreApplication.instance()
+        app.postEvent(self,QtCore.QEvent(self.event_type))
+        return future
+
+    def customEvent(self,event):
+        if event.type() == self.event_type:
+            with self._lock:
+                self._wakeup_pending = False
+            while True:
+                try:
+                    (future,func,args,kwds) = self.calls.popleft()
+                except IndexError:
+                    break
+                future.call_function(func,*args,**kwds)
+
+
+_THREAD_DISPATCHERS = {}
+_THREAD_DISPATCHERS_LOCK = threading.Lock()
+
+
+def _get_thread_dispatcher(qthread):
+    """Get the _ThreadDispatcher for the given QThread, creating if needed.
+
+    The dispatcher is discarded when the thread finishes, so that stale
+    dispatchers don't keep the thread object alive.
+    """
+    with _THREAD_DISPATCHERS_LOCK:
+        try:
+            return _THREAD_DISPATCHERS[qthread]
+        except KeyError:
+            pass
+        dispatcher = _ThreadDispatcher(qthread)
+        _THREAD_DISPATCHERS[qthread] = dispatcher
+    def on_finished():
+        with _THREAD_DISPATCHERS_LOCK:
+            if _THREAD_DISPATCHERS.get(qthread) is dispatcher:
+                del _THREAD_DISPATCHERS[qthread]
+    qthread.finished.connect(on_finished)
+    return dispatcher
+
+
+def qCallInThread(qthread,func,*args,**kwds):
+    """Asynchronously call the given function in the given QThread.
+
+    This helper arranges for the given function to be called by the event
+    loop of the given QThread, which must be running an event loop (e.g.
+    via its default run() method).  It returns a Future object that can be
+    used to retreive the result of the call.
+
+    Calls are dispatched via a lightweight helper object that lives in the
+    target thread, so work can be spread across several event-loop threads
+    rather than all going through the main GUI thread.  Calls to a given
+    thread are executed in the order they were made.
+    """
+    return _get_thread_dispatcher(qthread).submit(func,args,kwds)
+
+
+def qCallInThreadAndWait(qthread,func,*args,**kwds):
+    """Synchronously call the given function in the given QThread.
+
+    This is the blocking version of qCallInThread.  If called from within
+    the target thread, the function is simply called directly.
+    """
+    if QtCore.QThread.currentThread() is qthread:
+        return func(*args,**kwds)
+    future = qCallInThread(qthread,func,*args,**kwds)
+    try:
+        return future.result()
+    finally:
+        future.recycle()
+
+
+class CancelToken(object):
+    """Cooperative cancellation flag for long-running worker tasks.
+
+    Python threads cannot be interrupted from outside, so a task that might
+    become obsolete should periodically check its token and stop early if
+    it has been cancelled:
+
+        def search(text):
+            token = qCurrentCancelToken()
+            for item in items:
+                token.check()
+                # ... match item against text
+
+    A token is cancelled by calling its cancel() method, or automatically
+    once its 'deadline' (a time.time() value) has passed.  A single token
+    can be shared between several tasks to cancel them all at once; tasks
+    with a cancelled token that are still waiting in a WorkerPool's queue
+    are dropped without being run.
+    """
+
+    def __init__(self,deadline=None):
+        self.deadline = deadline
+        self._cancelled = False
+
+    @classmethod
+    def with_timeout(cls,timeout):
+        """Create a token that will be cancelled after 'timeout' seconds."""
+        return cls(time.time() + timeout)
+
+    def cancel(self):
+        """Cancel the token."""
+        self._cancelled = True
+
+    def is_cancelled(self):
+        """Check whether the token was cancelled or its deadline has passed."""
+        if self._cancelled:
+            return True
+        if self.deadline is not None and time.time() >= self.deadline:
+            self._cancelled = True
+            return True
+        return False
+
+    def remaining(self):
+        """Get the number of seconds until the deadline, or None."""
+        if self.deadline is None:
+            return None
+        return max(0,self.deadline - time.time())
+
+    def check(self):
+        """Raise CancelledError if the token has been cancelled."""
+        if self.is_cancelled():
+            raise CancelledError()
+
+
+_task_local = threading.local()
+
+
+def qCurrentCancelToken():
+    """Get the CancelToken for the task running in the current thread.
+
+    This returns None if the current thread is not running a task that was
+    submitted with a token; see WorkerPool.submit_task().
+    """
+    return getattr(_task_local,"token",None)
+
+
+def _default_max_workers():
+    """Pick a sensible default size for a pool of worker threads."""
+    try:
+        return max(4,cpu_count() * 2)
+    except (TypeError,NotImplementedError):
+        return 4
+
+
+class WorkerPool(object):
+    """A pool of reusable background threads for executing function calls.
+
+    Instances of this class manage a bounded set of daemon worker threads
+    that pull tasks from a shared queue.  Threads are spawned lazily when
+    there is work waiting and no idle thread to take it, up to a maximum of
+    'max_workers' threads.  A thread that sits idle for 'idle_timeout'
+    seconds will exit, so a burst of activity doesn't leave lots of idle
+    threads lying around.
+
+    If 'max_queue' is greater than zero then at most that many tasks may be
+    waiting for a thread; further calls to submit() will block until there
+    is room in the queue.
+
+    Call the submit() method (or just call the pool directly) to execute a
+    function in a worker thread; it returns a Future object.  To be able to
+    cancel the task once it has started, or to give it a deadline, use the
+    submit_task() method instead.
+    """
+
+    def __init__(self,name=None,max_workers=None,max_queue=0,idle_timeout=30):
+        if max_workers is None:
+            max_workers = _default_max_workers()
+        self.name = name
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+        self.task_queue = Queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._num_workers = 0
+        self._num_idle = 0
+        self._num_spawned = 0
+        self._threads = set()
+        self._shutdown = False
+
+    def configure(self,max_workers=None,max_queue=None,idle_timeout=None):
+        """Adjust the configuration of this pool.
+
+        Changes take effect for subsequently-submitted tasks; any surplus
+        worker threads will exit once they become idle.
+        """
+        with self._lock:
+            if max_workers is not None:
+                self.max_workers = max_workers
+            if max_queue is not None:
+                self.task_queue.maxsize = max_queue
+            if idle_timeout is not None:
+                self.idle_timeout = idle_timeout
+
+    def submit(self,func,*args,**kwds):
+        """Asynchronously call the given function in a worker thread.
+
+        This method returns a Future object that can be used to retreive
+        the result of the call.
+        """
+        return self._submit(func,args,kwds,None)
+
+    __call__ = submit
+
+    def submit_task(self,func,args=(),kwds=None,token=None,timeout=None):
+        """Asynchronously call a cancellable function in a worker thread.
+
+        This is like submit(), but associates the task with a CancelToken.
+        If 'token' is not given then a new token is created, which expires
+        after 'timeout' seconds if that is given.  The function can find its
+        token by calling qCurrentCancelToken().
+
+        Calling cancel() on the returned Future removes the task from the
+        queue if it hasn't started, and cancels its token if it has.  The
+        token is also available as the future's 'token' attribute.
+        """
+        if kwds is None:
+            kwds = {}
+        if token is None:
+            token = CancelToken()
+            if timeout is not None:
+                token.deadline = time.time() + timeout
+        elif timeout is not None:
+            deadline = time.time() + timeout
+            if token.deadline is None or deadline < token.deadline:
+                token.deadline = deadline
+        return self._submit(func,args,kwds,token)
+
+    def _submit(self,func,args,kwds,token):
+        if self._shutdown:
+            raise RuntimeError("WorkerPool has been shut down")
+        future = Future.get_or_create()
+        future._token = token
+        if _instrumentation is not None:
+            name = "WorkerPool:%s" % (self.name,)
+            func = _instrumentation.wrap_call(name,func)
+            _instrumentation.record_depth(name,self.task_queue.qsize() + 1)
+        if _tracer is not None:
+            func = _tracer.wrap_call("WorkerPool:%s" % (self.name,),func)
+        self.task_queue.put((future,func,args,kwds,token))
+        with self._lock:
+            if self._num_workers < self.max_workers:
+                if self.task_queue.qsize() > self._num_idle:
+                    self._spawn_worker()
+        return future
+
+    def shutdown(self,wait=True):
+        """Shut down the pool, after all pending tasks have been executed.
+
+        If 'wait' is true then this method blocks until all worker threads
+        have exited.
+        """
+        with self._lock:
+            self._shutdown = True
+            workers = list(self._threads)
+            num_workers = self._num_workers
+        #  Post the sentinels without holding the lock; if the queue is full
+        #  then put() blocks, and the workers need the lock to drain it.
+        for _ in xrange(num_workers):
+            self.task_queue.put(None)
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def _spawn_worker(self):
+        #  This must be called while holding self._lock.
+        self._num_workers += 1
+        self._num_spawned += 1
+        name = "%s-%d" % (self.name or "WorkerPool",self._num_spawned,)
+        t = threading.Thread(target=self._run_worker,name=name)
+        t.daemon = True
+        self._threads.add(t)
+        t.start()
+
+    def _exit_worker(self):
+        #  This must be called while holding self._lock.
+        self._num_workers -= 1
+        self._threads.discard(threading.currentThread())
+
+    def _run_worker(self):
+        #  Keep a local reference to Queue.Empty, since module globals may
+        #  be cleared out from under daemon threads at interpreter shutdown.
+        Empty = Queue.Empty
+        while True:
+            with self._lock:
+                self._num_idle += 1
+            try:
+                task = self.task_queue.get(True,self.idle_timeout)
+            except Empty:
+                #  Exit if we've been idle for too long, but double-check
+                #  that no new tasks have arrived in the meantime.
+                with self._lock:
+                    self._num_idle -= 1
+                    if self.task_queue.empty():
+                        self._exit_worker()
+                        return
+                continue
+            with self._lock:
+                self._num_idle -= 1
+            if task is None:
+                with self._lock:
+                    self._exit_worker()
+                return
+            (future,func,args,kwds,token) = task
+            if _instrumentation is not None:
+                _instrumentation.record_utilization(self)
+            if token is None:
+                future.call_function(func,*args,**kwds)
+            else:
+                #  Drop tasks that became obsolete while in the queue.
+                if token.is_cancelled():
+                    future.cancel()
+                _task_local.token = token
+                try:
+                    future.call_function(func,*args,**kwds)
+                finally:
+                    _task_local.token = None
+            #  Exit if the pool has shrunk while we were busy.
+            with self._lock:
+                if self._num_workers > self.max_workers:
+                    self._exit_worker()
+                    return
+
+
+_WORKER_POOLS = {}
+_WORKER_POOLS_LOCK = threading.Lock()
 
+
+def qWorkerPool(name=None,**kwds):
+    """Get the WorkerPool with the given name, creating it if necessary.
+
+    Calling this function with no name returns the default pool, which is
+    used by qCallInWorkerThread.  Any keyword arguments are used to create
+    or reconfigure the pool; see the WorkerPool class for details.
+
+    Since pools are callable, a named pool can be used anywhere a call
+    helper is expected.  For example, to execute all calls to a function in
+    a dedicated pool with a single worker thread:
+
+        @qCallUsing(qWorkerPool("db",max_workers=1))
+        def save_record(record):
+            # ... write record to the database
+
+    """
+    with _WORKER_POOLS_LOCK:
+        try:
+            pool = _WORKER_POOLS[name]
+        except KeyError:
+            pool = _WORKER_POOLS[name] = WorkerPool(name,**kwds)
+            return pool
+    if kwds:
+        pool.configure(**kwds)
+    return pool
+
+
+class SerialQueue(object):
+    """A queue of function calls that are executed one at a time, in order.
+
+    Calls submitted to a SerialQueue are run in a WorkerPool, but never
+    more than one at a time and always in the order they were submitted.
+    This gives exclusive access to a resource (e.g. an output file) without
+    needing a lock, and without tying up a dedicated thread: while the queue
+    has work it occupies a single pooled thread, which is handed back to
+    the pool as soon as the queue is empty.
+
+    Different SerialQueues run in parallel with each other.  To keep the
+    pool fair, a busy queue hands back its thread after running at most
+    'max_batch' calls, and resubmits itself to the back of the pool's queue.
+
+    This means that consecutive calls may run on different threads.  Don't
+    use a SerialQueue for resources that can only be used from the thread
+    that created them, such as sqlite3 connections; run those calls in a
+    dedicated QThread via qCallInThread instead.
+
+    Call the submit() method (or just call the queue directly) to execute
+    a function; it returns a Future object.
+    """
+
+    def __init__(self,name=None,pool=None,max_batch=16):
+        self.name = name
+        self.pool = pool
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._calls = deque()
+        self._active = False
+
+    def submit(self,func,*args,**kwds):
+        """Asynchronously call the given function after all pending calls.
+
+        This method returns a Future object that can be used to retreive
+        the result of the call.
+        """
+        future = Future.get_or_create()
+        call = (future,func,args,kwds)
+        with self._lock:
+            self._calls.append(call)
+            if self._active:
+                return future
+            self._active = True
+        try:
+            self._schedule()
+        except Exception:
+            with self._lock:
+                self._calls.remove(call)
+            raise
+        return future
+
+    __call__ = submit
+
+    def num_pending(self):
+        """Get the number of calls waiting to be executed."""
+        return len(self._calls)
+
+    def _schedule(self):
+        pool = self.pool
+        if pool is None:
+            pool = qWorkerPool()
+        try:
+            pool.submit(self._run_calls)
+        except Exception:
+            #  Let the next call to submit() try again.
+            with self._lock:
+                self._active = False
+            raise
+
+    def _run_calls(self):
+        for _ in xrange(self.max_batch):
+            with self._lock:
+                try:
+                    (future,func,args,kwds) = self._calls.popleft()
+                except IndexError:
+                    self._active = False
+                    return
+            future.call_function(func,*args,**kwds)
+        with self._lock:
+            if not self._calls:
+                self._active = False
+                return
+        self._schedule()
+
+
+_SERIAL_QUEUES = {}
+_SERIAL_QUEUES_LOCK = threading.Lock()
+
+
+def qSerialQueue(name,pool=None):
+    """Get the SerialQueue with the given name, creating it if necessary.
+
+    Since serial queues are callable, they can be used with qCallUsing to
+    serialize all calls to a function.  For example, the following ensures
+    that records are written one at a time and in order, without blocking
+    the calling thread:
+
+        @qCallUsing(qSerialQueue("log"))
+        def write_record(record):
+            # ... append record to the log file
+
+    If 'pool' is given, it's the WorkerPool used to run the queue's calls
+    when creating a new queue; otherwise the default pool is used.
+    """
+    with _SERIAL_QUEUES_LOCK:
+        try:
+            return _SERIAL_QUEUES[name]
+        except KeyError:
+            queue = _SERIAL_QUEUES[name] = SerialQueue(name,pool)
+            return queue
+
+
+def qCallInWorkerThread(func,*args,**kwds):
+    """Asynchronously call the given function in a background worker thread.
+
+    This helper arranges for the given function to be executed by a background
+    worker thread, taken from the default WorkerPool.  Use qWorkerPool() to
+    adjust the size of the default pool.
+
+    If you need to know the result of the function call, this helper returns
+    a Future object; use f.is_ready() to test whether it's ready and call
+    f.get_result() to get the return value or raise the exception.
+    """
+    return qWorkerPool().submit(func,*args,**kwds)
+
+
+class TaskGroupError(Exception):
+    """Exception raised when one or more tasks in a TaskGroup failed.
+
+    The 'exceptions' attribute holds the list of exceptions raised by the
+    failed tasks, in the order in which they failed.
+    """
+
+    def __init__(self,exceptions):
+        self.exceptions = list(exceptions)
+        msg = "%d task(s) failed: %s" % (len(self.exceptions),
+                                         ", ".join(map(repr,exceptions)))
+        super(TaskGroupError,self).__init__(msg)
+
+
+class TaskGroup(object):
+    """A group of related worker tasks that succeed or fail together.
+
+    Tasks are submitted to the group via its submit() method (or by calling
+    the group directly) and run in a WorkerPool.  As soon as any task fails,
+    the others are cancelled: those still in the queue are dropped, and
+    those already running have their shared CancelToken cancelled.
+
+    Used as a context manager, the group waits for all its tasks on exit
+    and raises TaskGroupError if any of them failed:
+
+        with TaskGroup() as group:
+            for url in urls:
+                group.submit(download,url)
+        pages = group.results()
+
+    If the body of the with-statement raises an exception, the tasks are
+    cancelled and the exception propagates as usual.
+
+    To avoid blocking the main thread, pass an 'on_done' callback and call
+    close() once all tasks have been submitted.  The callback is called in
+    the main thread with the group as its only argument, once all the tasks
+    have completed; use the exceptions() or results() methods to find out
+    what happened.
+    """
+
+    def __init__(self,pool=None,on_done=None):
+        if pool is None:
+            pool = qWorkerPool()
+        self.pool = pool
+        self.on_done = on_done
+        self.token = CancelToken()
+        self.futures = []
+        self._lock = threading.Lock()
+        self._exceptions = []
+        self._num_pending = 0
+        self._closed = False
+        #  Set whenever there are no pending tasks.  We can't just wait on
+        #  the futures themselves, since waiters are woken before the
+        #  done-callbacks have recorded any failures.
+        self._all_done = threading.Event()
+        self._all_done.set()
+
+    def submit(self,func,*args,**kwds):
+        """Asynchronously call the given function as part of the group.
+
+        This method returns a Future object for the individual task.
+        """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("TaskGroup has been closed")
+            self._num_pending += 1
+            self._all_done.clear()
+        future = self.pool.submit_task(func,args,kwds,token=self.token)
+        self.futures.append(future)
+        future.add_done_callback(self._on_task_done)
+        return future
+
+    __call__ = submit
+
+    def cancel(self):
+        """Cancel all the tasks in the group."""
+        self.token.cancel()
+        for future in list(self.futures):
+            future.cancel()
+
+    def close(self):
+        """Indicate that no more tasks will be submitted to the group.
+
+        The 'on_done' callback is only called once the group is closed.
+        """
+        with self._lock:
+            self._closed = True
+            finished = (self._num_pending == 0)
+        if finished:
+            self._finish()
+
+    def wait(self,timeout=None):
+        """Wait for all tasks to complete, raising TaskGroupError on failure.
+
+        If 'timeout' is given and the tasks don't complete in time, this
+        raises TimeoutError.
+        """
+        self._all_done.wait(timeout)
+        if not self._all_done.isSet():
+            raise TimeoutError()
+        exceptions = self.exceptions()
+        if exceptions:
+            raise TaskGroupError(exceptions)
+
+    def exceptions(self):
+        """Get the list of exceptions raised by failed tasks."""
+        with self._lock:
+            return list(self._exceptions)
+
+    def results(self):
+        """Get the list of task results, in the order they were submitted.
+
+        This waits for any incomplete tasks, and raises TaskGroupError if
+        any of the tasks failed.
+        """
+        self.wait()
+        return [future.result() for future in self.futures]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        if exc_type is not None:
+            self.cancel()
+        self.close()
+        if exc_type is not None:
+            self._all_done.wait()
+            return False
+        self.wait()
+        return False
+
+    def _on_task_done(self,future):
+        failed = False
+        if not future.cancelled():
+            exc = future.exception()
+            #  Tasks that stopped in response to cancellation don't count
+            #  as failures in their own right.
+            if exc is not None and not isinstance(exc,CancelledError):
+                with self._lock:
+                    self._exceptions.append(exc)
+                failed = True
+        if failed:
+            self.cancel()
+        with self._lock:
+            self._num_pending -= 1
+            if self._num_pending == 0:
+                self._all_done.set()
+            finished = (self._closed and self._num_pending == 0)
+        if finished:
+            self._finish()
+
+    def _finish(self):
+        if self.on_done is not None:
+            _call_after_exempt(self.on_done,self)
+
+
+class _ItemStream(object):
+    """Helper for passing batches of items from a worker to the main thread.
+
+    At most 'max_pending' batches may be waiting for the consumer at any
+    time; the worker blocks in deliver() until the main thread catches up.
+    """
+
+    def __init__(self,consumer,token,max_pending):
+        self.consumer = consumer
+        self.token = token
+        self.max_pending = max_pending
+        self.num_pending = 0
+        self.condition = threading.Condition()
+
+    def deliver(self,batch):
+        with self.condition:
+            while self.num_pending >= self.max_pending:
+                self.token.check()
+                #  Wait with a timeout, so we notice if we're cancelled.
+                self.condition.wait(0.1)
+            self.num_pending += 1
+        _call_after_exempt(self.consume,batch)
+
+    def consume(self,batch):
+        try:
+            if not self.token.is_cancelled():
+                self.consumer(batch)
+        except Exception:
+            logger.exception("exception consuming streamed items")
+            self.token.cancel()
+        finally:
+            with self.condition:
+                self.num_pending -= 1
+                self.condition.notify()
+
+    def run(self,func,args,kwds,max_batch,max_delay):
+        num_items = 0
+        batch = []
+        iterator = iter(func(*args,**kwds))
+        try:
+            batch_start = time.time()
+            for item in iterator:
+                self.token.check()
+                batch.append(item)
+                if len(batch) >= max_batch:
+                    flush = True
+                else:
+                    flush = (time.time() - batch_start >= max_delay)
+                if flush:
+                    self.deliver(batch)
+                    num_items += len(batch)
+                    batch = []
+                    batch_start = time.time()
+            if batch:
+                self.deliver(batch)
+                num_items += len(batch)
+        finally:
+            close = getattr(iterator,"close",None)
+            if close is not None:
+                close()
+        return num_items
+
+
+def qStreamInWorkerThread(func,consumer,args=(),kwds=None,max_batch=100,
+                          max_delay=0.05,max_pending=4,pool=None,token=None):
+    """Stream items from a worker thread to a consumer in the main thread.
+
+    This helper is like qCallInWorkerThread, but for functions that produce
+    a sequence of items (typically generator functions).  It iterates over
+    func(*args,**kwds) in a background worker thread, and calls consumer()
+    in the main thread with successive lists of items.  This lets a view
+    populate incrementally rather than waiting for the entire result.
+
+    A batch is delivered once it holds 'max_batch' items, or once an item
+    arrives at least 'max_delay' seconds after the batch was started.  To
+    keep memory usage bounded, the worker pauses if 'max_pending' batches
+    are waiting for the consumer.
+
+    The returned Future gives the total number of items delivered.  It can
+    be cancelled like any other task submitted with WorkerPool.submit_task;
+    the stream is also cancelled if the consumer raises an exception.
+    To be notified when the stream has been fully consumed, add a done
+    callback with in_main_thread=True.
+    """
+    if kwds is None:
+        kwds = {}
+    if pool is None:
+        pool = qWorkerPool()
+    if token is None:
+        token = CancelToken()
+    stream = _ItemStream(consumer,token,max_pending)
+    return pool.submit_task(stream.run,(func,args,kwds,max_batch,max_delay),
+                            token=token)
+
+
+def _map_chunk(func,chunk):
+    return [func(item) for item in chunk]
+
+
+def _iter_chunks(iterable,chunksize):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def qParallelMap(func,iterable,chunksize=1,ordered=True,max_in_flight=None,
+                 progress=None,pool=None):
+    """Map the given function over an iterable using worker threads.
+
+    This helper splits the iterable into chunks of 'chunksize' items and
+    runs each chunk as a single task in a WorkerPool.  It returns an
+    iterator over the results; if 'ordered' is false then results are
+    produced in whatever order the chunks complete, which may let you start
+    processing them sooner.
+
+    The iterable is consumed lazily, with at most 'max_in_flight' chunks
+    submitted to the pool at any time; this defaults to twice the number of
+    workers in the pool.  If 'progress' is given, it is called in the main
+    thread with the total number of items processed so far each time a
+    chunk completes.
+
+    If any call raises an exception, the outstanding chunks are cancelled
+    and the exception is re-raised from the iterator.  Since iterating over
+    the results will block, you probably don't want to do it from the main
+    thread.
+    """
+    if chunksize < 1:
+        raise ValueError("chunksize must be at least 1")
+    if pool is None:
+        pool = qWorkerPool()
+    if max_in_flight is None:
+        max_in_flight = max(1,pool.max_workers * 2)
+    return _parallel_map(func,iterable,chunksize,ordered,max_in_flight,
+                         progress,pool)
+
+
+def _parallel_map(func,iterable,chunksize,ordered,max_in_flight,
+                  progress,pool):
+    chunks = _iter_chunks(iterable,chunksize)
+    in_flight = deque()
+    #  This is only updated from the main thread, so no lock is needed.
+    num_processed = [0]
+    def on_chunk_done(future):
+        if not future.cancelled() and future.exception() is None:
+            num_processed[0] += len(future.result())
+            progress(num_processed[0])
+    def submit_chunks():
+        while len(in_flight) < max_in_flight:
+            try:
+                chunk = chunks.next()
+            except StopIteration:
+                return
+            future = pool.submit(_map_chunk,func,chunk)
+            if progress is not None:
+                future.add_done_callback(on_chunk_done,in_main_thread=True)
+            in_flight.append(future)
+    try:
+        submit_chunks()
+        while in_flight:
+            if ordered:
+                future = in_flight.popleft()
+            else:
+                (done,_) = wait_any(in_flight)
+                future = done.pop()
+                in_flight.remove(future)
+            results = future.result()
+            submit_chunks()
+            for result in results:
+                yield result
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+
+def _call_in_process(payload):
+    """Execute a pickled (func,args,kwds) call in a worker process.
+
+    This returns a (success,value) pair, where 'value' is either the return
+    value of the function or the exception that it raised.
+    """
+    try:
+        (func,args,kwds) = pickle.loads(payload)
+    except Exception:
+        return _exception_outcome()
+    return _invoke_in_process(func,args,kwds)
+
+
+def _call_chunk_in_process(payload):
+    """Execute a pickled (func,items) batch of calls in a worker process.
+
+    This returns a list of (success,value) pairs, one for each item.
+    """
+    try:
+        (func,items) = pickle.loads(payload)
+    except Exception:
+        return [_exception_outcome()]
+    return [_invoke_in_process(func,(item,),{}) for item in items]
+
+
+def _invoke_in_process(func,args,kwds):
+    #  The result is test-pickled here, since if it can't be sent back to
+    #  the parent process then the pool would never report the outcome.
+    try:
+        result = func(*args,**kwds)
+        pickle.dumps(result,pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return _exception_outcome()
+    return (True,result)
+
+
+def _exception_outcome():
+    #  Exceptions that can't be pickled are replaced by a RuntimeError.
+    (typ,value,tb) = sys.exc_info()
+    remote_traceback = "".join(traceback.format_exception(typ,value,tb))
+    try:
+        value.remote_traceback = remote_traceback
+        pickle.dumps(value,pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        value = RuntimeError(remote_traceback)
+    return (False,value)
+
+
+def _set_future_outcome(future,outcome):
+    (success,value) = outcome
+    if success:
+        future.set_result(value)
+    else:
+        future.set_exception(value)
+
+
+def _apply_async(pool,func,payload,callback,errback):
+    #  Only python3 can tell us about failures in the pool machinery itself,
+    #  e.g. if the outcome can't be sent back from the worker process.
+    if sys.version_info[0] >= 3:
+        pool.apply_async(func,(payload,),callback=callback,
+                         error_callback=errback)
+    else:
+        pool.apply_async(func,(payload,),callback=callback)
+
+
+class WorkerProcessPool(object):
+    """A persistent pool of worker processes for CPU-bound function calls.
+
+    This class wraps a multiprocessing.Pool, which is started on first use
+    and kept running until shutdown() is called (or the program exits).
+    Calls are submitted via submit(), which returns a Future just like the
+    thread-based WorkerPool.  Add a done-callback with in_main_thread=True
+    to have the result delivered to the main thread via qCallAfter.
+
+    The function and its arguments must be picklable.  They are pickled in
+    the calling thread, so any errors are reported immediately.  To amortize
+    pickling overhead over many small calls, use the map() method to send
+    the arguments in chunks.
+    """
+
+    def __init__(self,processes=None):
+        self.processes = processes
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                if multiprocessing is None:
+                    raise RuntimeError("multiprocessing is not available")
+                self._pool = multiprocessing.Pool(self.processes)
+                atexit.register(self.shutdown,False)
+            return self._pool
+
+    def submit(self,func,*args,**kwds):
+        """Asynchronously call the given function in a worker process.
+
+        This method returns a Future object that can be used to retreive
+        the result of the call.
+        """
+        future = Future.get_or_create()
+        try:
+            payload = pickle.dumps((func,args,kwds),pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            future.set_exc_info(sys.exc_info())
+            return future
+        future.set_running_or_notify_cancel()
+        def callback(outcome):
+            _set_future_outcome(future,outcome)
+        _apply_async(self._get_pool(),_call_in_process,payload,
+                     callback,future.set_exception)
+        return future
+
+    __call__ = submit
+
+    def map(self,func,iterable,chunksize=None):
+        """Asynchronously call the function with each item of an iterable.
+
+        The items are sent to the worker processes in batches of 'chunksize'
+        items.  This method returns a Future whose result will be the list
+        of return values, or the first exception raised.
+        """
+        items = list(iterable)
+        future = Future.get_or_create()
+        future.set_running_or_notify_cancel()
+        if not items:
+            future.set_result([])
+            return future
+        if chunksize is None:
+            num_processes = self.processes or _default_max_processes()
+            (chunksize,extra) = divmod(len(items),num_processes * 4)
+            if extra or not chunksize:
+                chunksize += 1
+        chunks = [items[i:i+chunksize]
+                  for i in xrange(0,len(items),chunksize)]
+        results = [None] * len(chunks)
+        state = {"remaining":len(chunks),"failed":False}
+        lock = threading.Lock()
+        def errback(exception):
+            with lock:
+                if state["failed"]:
+                    return
+                state["failed"] = True
+            future.set_exception(exception)
+        def make_callback(index):
+            def callback(outcomes):
+                with lock:
+                    if state["failed"]:
+                        return
+                    for (success,value) in outcomes:
+                        if not success:
+                            state["failed"] = True
+                            break
+                    else:
+                        results[index] = [value for (_,value) in outcomes]
+                        state["remaining"] -= 1
+                        if state["remaining"] > 0:
+                            return
+                if state["failed"]:
+                    future.set_exception(value)
+                else:
+                    future.set_result([v for chunk in results for v in chunk])
+            return callback
+        pool = self._get_pool()
+        for (index,chunk) in enumerate(chunks):
+            try:
+                payload = pickle.dumps((func,chunk),pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                with lock:
+                    state["failed"] = True
+                future.set_exc_info(sys.exc_info())
+                break
+            _apply_async(pool,_call_chunk_in_process,payload,
+                         make_callback(index),errback)
+        return future
+
+    def shutdown(self,wait=True):
+        """Shut down the worker processes.
+
+        If 'wait' is true then this waits for any outstanding calls to
+        complete; otherwise the worker processes are terminated immediately.
+        The pool will be restarted if any further calls are submitted.
+        """
+        with self._lock:
+            pool = self._pool
+            self._pool = None
+        if pool is not None:
+            if wait:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+
+
+def _default_max_processes():
+    try:
+        return cpu_count()
+    except (TypeError,NotImplementedError):
+        return 1
+
+
+_WORKER_PROCESS_POOL = WorkerProcessPool()
+
+
+def qWorkerProcessPool(processes=None):
+    """Get the shared WorkerProcessPool used by qCallInWorkerProcess.
+
+    If 'processes' is given then the pool is reconfigured to use that many
+    processes, restarting it if necessary.
+    """
+    pool = _WORKER_PROCESS_POOL
+    if processes is not None and processes != pool.processes:
+        pool.shutdown()
+        pool.processes = processes
+    return pool
+
+
+def qCallInWorkerProcess(func,*args,**kwds):
+    """Asynchronously call the given function in a background worker process.
+
+    This helper is like qCallInWorkerThread, but the function is executed
+    in a separate process so that CPU-intensive work doesn't contend with
+    the main thread for the GIL.  It returns a Future object.  The function
+    and its arguments must be picklable.
+    """
+    return _WORKER_PROCESS_POOL.submit(func,*args,**kwds)
+
+
+def qMapInWorkerProcess(func,iterable,chunksize=None):
+    """Asynchronously map the given function over an iterable in processes.
+
+    This helper sends items from the iterable to the background worker
+    processes in chunks, amortizing the pickling overhead over many calls.
+    It returns a Future whose result will be the list of return values.
+    """
+    return _WORKER_PROCESS_POOL.map(func,iterable,chunksize)
+
+
+class ScheduledCall(object):
+    """Handle for a function call scheduled via qCallLater.
+
+    Call the cancel() method to prevent the function from being called, or
+    the reschedule() method to push the call back to a new interval from the
+    current time.
+    """
+
+    def __init__(self,wheel,func,args,kwds):
+        self.wheel = wheel
+        self.func = func
+        self.args = args
+        self.kwds = kwds
+        self._expiry_tick = None
+        self._generation = 0
+        self._pending = False
+
+    def cancel(self):
+        """Cancel the call, if it has not already happened."""
+        self.wheel.cancel(self)
+
+    def reschedule(self,interval):
+        """Reschedule the call for 'interval' seconds from now.
+
+        This works even if the call has already happened or been cancelled,
+        in which case it will happen again.
+        """
+        self.wheel.schedule(self,interval)
+
+    def is_pending(self):
+        """Check whether the call is still waiting to happen."""
+        return self._pending
+
+    def _fire(self,generation):
+        #  Calls that were cancelled or rescheduled after expiring will
+        #  have a new generation number, so they're ignored here.
+        if generation != self._generation:
+            return
+        self._pending = False
+        self.func(*self.args,**self.kwds)
+
+
+class TimerWheel(object):
+    """Hashed timer wheel for cheaply scheduling lots of function calls.
+
+    Scheduled calls are hashed into one of 'num_slots' buckets according to
+    their expiry time, rounded up to a multiple of 'resolution' seconds.
+    A single QTimer in the main thread ticks over each bucket in turn and
+    dispatches any expired calls via qCallAfter.  Scheduling and cancelling
+    a call are both constant-time operations, and can be done from any
+    thread.  The QTimer is stopped whenever there are no calls scheduled.
+    """
+
+    def __init__(self,resolution=0.01,num_slots=512):
+        self.resolution = resolution
+        self.num_slots = num_slots
+        self._slots = [set() for _ in xrange(num_slots)]
+        self._epoch = time.time()
+        self._current_tick = 0
+        self._num_scheduled = 0
+        self._lock = threading.Lock()
+        self._running = False
+        self._timer = None
+
+    def schedule(self,handle,interval):
+        """Schedule the given ScheduledCall for 'interval' seconds from now."""
+        expiry = time.time() + interval - self._epoch
+        expiry_tick = int(math.ceil(expiry / self.resolution))
+        with self._lock:
+            self._unschedule(handle)
+            expiry_tick = max(expiry_tick,self._current_tick + 1)
+            handle._expiry_tick = expiry_tick
+            handle._generation += 1
+            handle._pending = True
+            self._slots[expiry_tick % self.num_slots].add(handle)
+            self._num_scheduled += 1
+            if self._running:
+                return
+            self._running = True
+        #  The QTimer can only be started from the main thread.
+        _call_after_exempt(self._startTimer)
+
+    def cancel(self,handle):
+        """Cancel the given ScheduledCall."""
+        with self._lock:
+            self._unschedule(handle)
+            handle._generation += 1
+            handle._pending = False
+
+    def _unschedule(self,handle):
+        #  This must be called while holding self._lock.
+        if handle._expiry_tick is not None:
+            slot = self._slots[handle._expiry_tick % self.num_slots]
+            slot.discard(handle)
+            handle._expiry_tick = None
+            self._num_scheduled -= 1
+
+    def _startTimer(self):
+        if self._timer is None:
+            self._timer = QtCore.QTimer()
+            self._timer.timeout.connect(self._onTick)
+        if not self._timer.isActive():
+            self._timer.start(max(1,int(self.resolution * 1000)))
+
+    def _onTick(self):
+        now_tick = int((time.time() - self._epoch) / self.resolution)
+        expired = []
+        with self._lock:
+            first_tick = self._current_tick + 1
+            if now_tick - first_tick >= self.num_slots:
+                #  We've fallen more than a full turn behind.
+                ticks = xrange(self.num_slots)
+            else:
+                ticks = xrange(first_tick,now_tick + 1)
+            for tick in ticks:
+                slot = self._slots[tick % self.num_slots]
+                if not slot:
+                    continue
+                for handle in [h for h in slot if h._expiry_tick <= now_tick]:
+                    slot.discard(handle)
+                    expired.append((handle._expiry_tick,handle))
+                    handle._expiry_tick = None
+                    self._num_scheduled -= 1
+            self._current_tick = max(self._current_tick,now_tick)
+            if self._num_scheduled == 0:
+                self._running = False
+                self._timer.stop()
+            expired.sort(key=lambda item: item[0])
+            expired = [(h,h._generation) for (_,h) in expired]
+        for (handle,generation) in expired:
+            _call_after_exempt(handle._fire,generation)
+
+
+_TIMER_WHEEL = TimerWheel()
+
+
+def qCallLater(interval,func,*args,**kwds):
+    """Asynchronously call the given function after a timeout.
+
+    This helper is similar to qCallAfter, but it waits at least 'interval'
+    seconds before executing the function.  It returns a ScheduledCall
+    object; to cancel the call before the interval has expired, call the
+    'cancel' method on this object.
+
+    Calls are scheduled on a shared TimerWheel, driven by a single QTimer in
+    the main thread, so it's cheap to schedule large numbers of them.
+    """
+    if _tracer is not None:
+        func = _tracer.wrap_call("qCallLater",func)
+    handle = ScheduledCall(_TIMER_WHEEL,func,args,kwds)
+    _TIMER_WHEEL.schedule(handle,interval)
+    return handle
+
+
+class _CallCollapser(object):
+    """Base class for helpers that collapse redundant calls to a function.
+
+    Calls are grouped by key; by default the key is the function itself,
+    but you can pass a function 'key' to compute a finer-grained key from
+    the call arguments.  For example, to collapse calls to a method on
+    a per-instance basis, use key=lambda self,*args,**kwds: self.
+    """
+
+    def __init__(self,key=None):
+        self.key = key
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def _get_key(self,func,args,kwds):
+        if self.key is None:
+            return func
+        return (func,self.key(*args,**kwds))
+
+    def _fire(self,key):
+        with self._lock:
+            (func,args,kwds) = self._pending.pop(key)[-3:]
+        func(*args,**kwds)
+
+
+class qCoalesce(_CallCollapser):
+    """Call helper that coalesces calls waiting to run in the main thread.
+
+    This helper works like qCallAfter, except that if there is already a
+    call with the same key waiting to run, it is replaced with the new one
+    rather than queueing an additional call.  It's useful for things like
+    progress updates from a worker thread, where only the latest values are
+    interesting:
+
+        @qCallUsing(qCoalesce())
+        def update_progress(done,total):
+            # ... update the progress bar
+
+    """
+
+    def __call__(self,func,*args,**kwds):
+        key = self._get_key(func,args,kwds)
+        with self._lock:
+            if key in self._pending:
+                self._pending[key] = (func,args,kwds)
+                return
+            self._pending[key] = (func,args,kwds)
+        _call_after_exempt(self._fire,key)
+
+
+class qDebounce(_CallCollapser):
+    """Call helper that waits for calls to stop arriving before running.
+
+    This helper delays each call until 'interval' seconds have passed
+    without any further calls with the same key, then calls the function
+    in the main thread using the most recent arguments.  It's useful for
+    things like search-as-you-type, where work should only be done once
+    the user pauses for a moment:
+
+        @qCallUsing(qDebounce(0.3))
+        def search(text):
+            # ... update the search results
+
+    """
+
+    def __init__(self,interval,key=None):
+        super(qDebounce,self).__init__(key)
+        self.interval = interval
+
+    def __call__(self,func,*args,**kwds):
+        key = self._get_key(func,args,kwds)
+        with self._lock:
+            try:
+                call = self._pending[key][0]
+            except KeyError:
+                call = qCallLater(self.interval,self._fire,key)
+            else:
+                call.reschedule(self.interval)
+            self._pending[key] = (call,func,args,kwds)
+
+
+class qThrottle(_CallCollapser):
+    """Call helper that limits the rate at which a function is called.
+
+    This helper calls the function in the main thread at most 'rate' times
+    per second for each key.  Calls arriving faster than that are collapsed
+    into a single trailing call using the most recent arguments, so the
+    final update is never lost:
+
+        @qCallUsing(qThrottle(10))
+        def show_status(msg):
+            # ... update the status bar
+
+    """
+
+    def __init__(self,rate,key=None):
+        super(qThrottle,self).__init__(key)
+        self.min_interval = 1.0 / rate
+        self._last_called = {}
+
+    def __call__(self,func,*args,**kwds):
+        key = self._get_key(func,args,kwds)
+        with self._lock:
+            if key in self._pending:
+                self._pending[key] = (func,args,kwds)
+                return
+            self._pending[key] = (func,args,kwds)
+            last_called = self._last_called.get(key,0)
+        delay = last_called + self.min_interval - time.time()
+        if delay <= 0:
+            _call_after_exempt(self._fire,key)
+        else:
+            qCallLater(delay,self._fire,key)
+
+    def _fire(self,key):
+        with self._lock:
+            self._last_called[key] = time.time()
+        super(qThrottle,self)._fire(key)
+
+
+class qCached(object):
+    """Call helper that memoizes the results of asynchronous calls.
+
+    This helper passes calls through to another helper (by default
+    qCallInWorkerThread) and caches the resulting Future, so that repeated
+    calls with the same arguments share a single result rather than each
+    doing the work again.  Concurrent calls that arrive while the first one
+    is still running are collapsed onto the same in-flight Future:
+
+        @qCallUsing(qCached(maxsize=100,ttl=60))
+        def load_thumbnail(path):
+            # ... expensive image scaling
+
+    At most 'maxsize' results are kept, with the least recently used being
+    evicted first; if 'ttl' is given then results also expire after that
+    many seconds.  Calls that raise an exception are not cached.  As with
+    qCoalesce and friends, calls are keyed by the function and by default
+    all its arguments, which must be hashable; pass a function 'key' to
+    compute the key from the call arguments instead.
+
+    The stats() method reports the number of hits, misses, collapsed calls,
+    evictions and expirations.
+    """
+
+    def __init__(self,maxsize=128,ttl=None,key=None,helper=None):
+        if helper is None:
+            helper = qCallInWorkerThread
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.key = key
+        self.helper = helper
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._in_flight = {}
+        self._stats = {"hits":0,"misses":0,"collapsed":0,
+                       "evictions":0,"expirations":0}
+
+    def _get_key(self,func,args,kwds):
+        if self.key is None:
+            return (func,args,tuple(sorted(kwds.iteritems())))
+        return (func,self.key(*args,**kwds))
+
+    def __call__(self,func,*args,**kwds):
+        key = self._get_key(func,args,kwds)
+        with self._lock:
+            try:
+                (expires,future) = self._cache.pop(key)
+            except KeyError:
+                pass
+            else:
+                if expires is None or expires > time.time():
+                    #  Re-insert to mark it as most recently used.
+                    self._cache[key] = (expires,future)
+                    self._stats["hits"] += 1
+                    return future
+                self._stats["expirations"] += 1
+            future = self._in_flight.get(key)
+            if future is not None and not future.cancelled():
+                self._stats["collapsed"] += 1
+                return future
+            self._stats["misses"] += 1
+            future = self._in_flight[key] = Future()
+        try:
+            result = self.helper(func,*args,**kwds)
+        except Exception:
+            self._on_done(key,future,None,sys.exc_info())
+        else:
+            if isinstance(result,Future):
+                result.add_done_callback(self._copy_state(key,future))
+            else:
+                self._on_done(key,future,result,None)
+        return future
+
+    def _copy_state(self,key,future):
+        def copy_state(result):
+            if result.cancelled():
+                with self._lock:
+                    self._in_flight.pop(key,None)
+                future.cancel()
+            else:
+                self._on_done(key,future,result._result,result._exc_info)
+        return copy_state
+
+    def _on_done(self,key,future,result,exc_info):
+        if future.cancelled():
+            pass
+        elif exc_info is None:
+            future.set_result(result)
+        else:
+            future.set_exc_info(exc_info)
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+            if exc_info is not None or future.cancelled():
+                return
+            if self.ttl is None:
+                expires = None
+            else:
+                expires = time.time() + self.ttl
+            self._cache[key] = (expires,future)
+            if self.maxsize is not None:
+                while len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+                    self._stats["evictions"] += 1
+
+    def clear(self):
+        """Discard all cached results."""
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self):
+        """Get a dict of statistics about the cache."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._cache)
+        return stats
+
+
+def qCallUsing(helper):
+    """Function/method decorator to always apply a function call helper.
+
+    This decorator can be used to ensure that a function is always called
+    using one of the qCall helpers.  For example, the following function can
+    be safely called from any thread, as it will transparently apply the
+    qCallInMainThread helper whenever it is called:
+
+        @qCallUsing(qCallInMainThread)
+        def prompt_for_input(msg):
+            # ... pop up a dialog, return input
+
+    If the helper has a 'can_call_inline' attribute, it must be a function
+    that returns True when the helper would just call the function directly
+    (e.g. qCallInMainThread when already in the main thread).  In that case
+    the decorated function is called immediately, bypassing the helper.
+    """
+    def decorator(func):
+        can_call_inline = getattr(helper,"can_call_inline",None)
+        if can_call_inline is None:
+            @wraps(func)
+            def wrapper(*args,**kwds):
+                return helper(func,*args,**kwds)
+        else:
+            @wraps(func)
+            def wrapper(*args,**kwds):
+                if can_call_inline():
+                    return func(*args,**kwds)
+                return helper(func,*args,**kwds)
+        return wrapper
+    return decorator
+
+
+class Histogram(object):
+    """Simple histogram of durations, with logarithmically-sized buckets.
+
+    Bucket i counts durations of less than 2**i microseconds (and at least
+    2**(i-1) microseconds, for i > 0).  This gives good resolution across
+    the range of timings we care about, at a fixed memory cost.
+    """
+
+    NUM_BUCKETS = 32
+
+    def __init__(self):
+        self.buckets = [0] * self.NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self,duration):
+        bucket = int(duration * 1000000).bit_length()
+        self.buckets[min(bucket,self.NUM_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += duration
+        if self.min is None or duration < self.min:
+            self.min = duration
+        if self.max is None or duration > self.max:
+            self.max = duration
+
+    def percentile(self,pct):
+        """Estimate the given percentile, as the upper bound of a bucket."""
+        if not self.count:
+            return None
+        target = self.count * pct / 100.0
+        seen = 0
+        for (i,num) in enumerate(self.buckets):
+            seen += num
+            if seen >= target:
+                return min(2**i / 1000000.0,self.max)
+        return self.max
+
+    def summary(self):
+        """Get a dict summarising the contents of the histogram."""
+        mean = None
+        if self.count:
+            mean = self.total / self.count
+        return {"count":self.count,"mean":mean,"min":self.min,"max":self.max,
+                "p50":self.percentile(50),"p90":self.percentile(90),
+                "p99":self.percentile(99),"buckets":list(self.buckets)}
+
+
+class _InstrumentedCall(object):
+    """Wrapper that times how long a call waits in a queue and executes."""
+
+    __slots__ = ("instrumentation","name","func","queued_at",)
+
+    def __init__(self,instrumentation,name,func):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.func = func
+        self.queued_at = time.time()
+
+    def __call__(self,*args,**kwds):
+        started_at = time.time()
+        try:
+            return self.func(*args,**kwds)
+        finally:
+            finished_at = time.time()
+            self.instrumentation.record_call(self.name,self.func,
+                                             started_at - self.queued_at,
+                                             finished_at - started_at)
+
+
+class CallInstrumentation(object):
+    """Collects timing statistics for calls made via the qCall helpers.
+
+    For each kind of call (e.g. "qCallAfter" or "WorkerPool:<name>") this
+    records a histogram of the time spent waiting in a queue and of the time
+    spent executing, as well as the current and peak queue depth.  For each
+    worker pool, it records the current and peak number of busy threads.
+
+    If 'threshold' is given, then any call that waits or executes for longer
+    than that many seconds is logged as a warning.
+    """
+
+    def __init__(self,threshold=None,logger=logger):
+        self.threshold = threshold
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._wait_times = {}
+        self._run_times = {}
+        self._depth = {}
+        self._peak_depth = {}
+        self._utilization = {}
+
+    def wrap_call(self,name,func):
+        return _InstrumentedCall(self,name,func)
+
+    def record_call(self,name,func,wait_time,run_time):
+        with self._lock:
+            try:
+                wait_times = self._wait_times[name]
+                run_times = self._run_times[name]
+            except KeyError:
+                wait_times = self._wait_times[name] = Histogram()
+                run_times = self._run_times[name] = Histogram()
+            wait_times.add(wait_time)
+            run_times.add(run_time)
+        if self.threshold is not None:
+            if wait_time > self.threshold or run_time > self.threshold:
+                msg = "slow call to %r via %s: waited %.3fs, ran %.3fs"
+                self.logger.warning(msg,func,name,wait_time,run_time)
+
+    def record_depth(self,name,depth):
+        with self._lock:
+            self._depth[name] = depth
+            if depth > self._peak_depth.get(name,0):
+                self._peak_depth[name] = depth
+
+    def record_utilization(self,pool):
+        name = "WorkerPool:%s" % (pool.name,)
+        with pool._lock:
+            busy = pool._num_workers - pool._num_idle
+        with self._lock:
+            (_,peak_busy) = self._utilization.get(name,(0,0))
+            self._utilization[name] = (busy,max(busy,peak_busy))
+
+    def stats(self):
+        """Get a dict of statistics, keyed by the kind of call."""
+        stats = {}
+        with self._lock:
+            names = set(self._wait_times)
+            names.update(self._depth)
+            for name in names:
+                info = stats[name] = {}
+                if name in self._wait_times:
+                    info["wait"] = self._wait_times[name].summary()
+                    info["run"] = self._run_times[name].summary()
+                info["depth"] = self._depth.get(name,0)
+                info["peak_depth"] = self._peak_depth.get(name,0)
+                if name in self._utilization:
+                    (busy,peak_busy) = self._utilization[name]
+                    info["busy_workers"] = busy
+                    info["peak_busy_workers"] = peak_busy
+        #  Fill in the current state of all the worker pools.
+        with _WORKER_POOLS_LOCK:
+            pools = list(_WORKER_POOLS.values())
+        for pool in pools:
+            info = stats.setdefault("WorkerPool:%s" % (pool.name,),{})
+            with pool._lock:
+                info["workers"] = pool._num_workers
+                info["busy_workers"] = pool._num_workers - pool._num_idle
+            info["max_workers"] = pool.max_workers
+            busy = info["busy_workers"]
+            info["utilization"] = busy / float(pool.max_workers)
+        return stats
+
+
+#  The currently-active CallInstrumentation object, if any.  The qCall
+#  helpers check this before doing any extra work, so there's almost no
+#  overhead when instrumentation is disabled.
+_instrumentation = None
+
+
+def qEnableInstrumentation(threshold=None):
+    """Start collecting timing statistics for the qCall helpers.
+
+    This returns the active CallInstrumentation object; use the function
+    qGetCallStats() to get a summary of the statistics collected so far.
+    If 'threshold' is given, any call that waits or executes for longer
+    than that many seconds is logged as a warning.
+    """
+    global _instrumentation
+    _instrumentation = CallInstrumentation(threshold)
+    return _instrumentation
+
+
+def qDisableInstrumentation():
+    """Stop collecting timing statistics for the qCall helpers."""
+    global _instrumentation
+    _instrumentation = None
+
+
+def qGetCallStats():
+    """Get a dict of timing statistics for the qCall helpers.
+
+    The dict maps the kind of call (e.g. "qCallAfter" for calls executed
+    in the main thread, "WorkerPool:<name>" for calls executed in a worker
+    pool) to a dict of statistics, including histogram summaries of the
+    time spent waiting ("wait") and executing ("run").  If instrumentation
+    is not enabled, this returns an empty dict.
+    """
+    instrumentation = _instrumentation
+    if instrumentation is None:
+        return {}
+    return instrumentation.stats()
+
+
+def _call_label(func):
+    """Get a human-readable label for the given function."""
+    while isinstance(func,(_InstrumentedCall,_TracedCall)):
+        func = func.func
+    try:
+        return func.__name__
+    except AttributeError:
+        return repr(func)
+
+
+class _TracedCall(object):
+    """Wrapper that records trace events when a queued call executes."""
+
+    __slots__ = ("tracer","name","func","flow_id",)
+
+    def __init__(self,tracer,name,func):
+        self.tracer = tracer
+        self.name = name
+        self.func = func
+        self.flow_id = tracer.record_enqueue(name,func)
+
+    def __call__(self,*args,**kwds):
+        started_at = time.time()
+        try:
+            return self.func(*args,**kwds)
+        finally:
+            self.tracer.record_execute(self.name,self.func,self.flow_id,
+                                       started_at,time.time())
+
+
+class CallTracer(object):
+    """Records the flow of calls between threads, in trace-event format.
+
+    Each call made via the qCall helpers records an event in the thread that
+    queued it, and a slice covering its execution in the thread that ran it,
+    linked by a flow arrow.  Events are kept in a ring buffer holding at
+    most 'max_events' entries, so tracing can be left running without
+    consuming unbounded memory.
+
+    Use the dump() method to write the events as JSON in the Chrome
+    trace-event format, which can be loaded into chrome://tracing or any
+    compatible trace viewer.
+    """
+
+    def __init__(self,max_events=100000):
+        self.max_events = max_events
+        self._events = deque(maxlen=max_events)
+        self._flow_ids = itertools.count(1)
+        self._thread_names = {}
+
+    def wrap_call(self,name,func):
+        return _TracedCall(self,name,func)
+
+    def _current_tid(self):
+        tid = thread.get_ident()
+        if tid not in self._thread_names:
+            self._thread_names[tid] = threading.currentThread().name
+        return tid
+
+    def record_enqueue(self,name,func):
+        #  Appending to a deque and advancing a counter are both atomic
+        #  operations, so we don't need a lock here.
+        flow_id = self._flow_ids.next()
+        self._events.append(("s",name,func,self._current_tid(),
+                             time.time(),None,flow_id))
+        return flow_id
+
+    def record_execute(self,name,func,flow_id,started_at,finished_at):
+        self._events.append(("X",name,func,self._current_tid(),
+                             started_at,finished_at - started_at,flow_id))
+
+    def record_span(self,name,func,started_at,finished_at):
+        self._events.append(("X",name,func,self._current_tid(),
+                             started_at,finished_at - started_at,None))
+
+    def events(self):
+        """Get the recorded events, as a list of trace-event dicts."""
+        pid = os.getpid()
+        trace = []
+        for (tid,name) in self._thread_names.items():
+            trace.append({"ph":"M","name":"thread_name","pid":pid,
+                          "tid":tid,"args":{"name":name}})
+        for (ph,name,func,tid,ts,dur,flow_id) in list(self._events):
+            event = {"ph":ph,"cat":name,"name":_call_label(func),
+                     "pid":pid,"tid":tid,"ts":ts * 1000000}
+            if ph == "X":
+                event["dur"] = dur * 1000000
+                if flow_id is not None:
+                    #  Terminate the flow arrow at the start of the slice.
+                    flow = dict(event,ph="f",bp="e",id=flow_id)
+                    del flow["dur"]
+                    trace.append(flow)
+            else:
+                event["id"] = flow_id
+            trace.append(event)
+        return trace
+
+    def dump(self,f):
+        """Write the recorded events as JSON to the given file or filename."""
+        data = {"traceEvents":self.events(),"displayTimeUnit":"ms"}
+        if isinstance(f,basestring):
+            with open(f,"w") as fileobj:
+                json.dump(data,fileobj)
+        else:
+            json.dump(data,f)
+
+    def clear(self):
+        """Discard all recorded events."""
+        self._events.clear()
+
+
+_tracer = None
+
+
+def qEnableTracing(max_events=100000):
+    """Start recording a trace of calls made via the qCall helpers.
+
+    This returns the active CallTracer object.  Use qDumpTrace() to write
+    out the trace once you've captured the activity of interest.
+    """
+    global _tracer
+    _tracer = CallTracer(max_events)
+    return _tracer
+
+
+def qDisableTracing():
+    """Stop recording a trace of calls made via the qCall helpers."""
+    global _tracer
+    _tracer = None
+
+
+def qDumpTrace(f):
+    """Write the trace of recent calls to the given file or filename.
+
+    The trace is written as JSON in the Chrome trace-event format.  If
+    tracing is not enabled, this raises RuntimeError.
+    """
+    tracer = _tracer
+    if tracer is None:
+        raise RuntimeError("tracing is not enabled")
+    tracer.dump(f)
@@ -8,33 +8,205 @@ PySideKick.Console:  a simple embeddable python shell
 This module provides the call QPythonConsole, a python shell that can be
 embedded in your GUI.
 
+By default commands are executed in the GUI thread, so a long-running command
+will freeze the application.  Pass threaded=True to execute them in a worker
+thread instead; output then streams into the console as it's produced, and
+pressing Ctrl+C raises KeyboardInterrupt in the running command.
+
 """
 
 import sys
+import thread
+import threading
+from collections import deque
 from code import InteractiveConsole as _InteractiveConsole
 
 from PySideKick import QtCore, QtGui
+from PySideKick.Call import WorkerPool, _call_after_exempt
 
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
 
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
+
+
+def _set_async_exc(thread_id,exc_type):
+    """Asynchronously raise an exception in the given thread.
+
+    If 'exc_type' is None, any pending asynchronous exception is cleared.
+    The exception is only raised once the thread next executes some python
+    code, so it won't interrupt a thread that's blocked in a system call.
+    Returns False if this isn't supported on the current platform.
+    """
+    if ctypes is None:
+        return False
+    set_async_exc = ctypes.pythonapi.PyThreadState_SetAsyncExc
+    if exc_type is None:
+        exc = ctypes.c_void_p(0)
+    else:
+        exc = ctypes.py_object(exc_type)
+    return set_async_exc(ctypes.c_ulong(thread_id),exc) == 1
+
+
+class _QPythonConsoleOutput(QtCore.QObject):
+    """Buffer for output written to the console.
+
+    Appending to a QPlainTextEdit is slow, so output is not written to the
+    widget immediately.  Instead it accumulates in a buffer that is flushed
+    into the widget by a timer, at most 'max_flush_bytes' per tick, so that
+    heavy output doesn't starve the event loop.  Since lines beyond the
+    widget's maximumBlockCount would be discarded anyway, the buffer only
+    keeps that many of the most recent lines.
+
+    The write() method may be called from any thread.
+    """
+
+    flush_interval = 16
+    max_flush_bytes = 64 * 1024
+
+    def __init__(self,output):
+        super(_QPythonConsoleOutput,self).__init__(None)
+        self.output = output
+        max_lines = output.maximumBlockCount()
+        if max_lines <= 0:
+            max_lines = None
+        self._lines = deque(maxlen=max_lines)
+        self._lock = threading.Lock()
+        self._flush_pending = False
+        self._timer = QtCore.QTimer(self)
+        self._timer.setInterval(self.flush_interval)
+        self._timer.timeout.connect(self._on_timer)
+
+    def write(self,data):
+        if data[-1:] == "\n":
+            data = data[:-1]
+        with self._lock:
+            self._lines.extend(data.split("\n"))
+            if self._flush_pending:
+                return
+            self._flush_pending = True
+        _call_after_exempt(self._timer.start)
+
+    def flush(self):
+        """Immediately write all buffered output into the widget."""
+        self._flush_lines(None)
+
+    def _on_timer(self):
+        self._flush_lines(self.max_flush_bytes)
+
+    def _flush_lines(self,max_bytes):
+        lines = []
+        size = 0
+        with self._lock:
+            while self._lines:
+                if max_bytes is not None and size >= max_bytes:
+                    break
+                line = self._lines.popleft()
+                lines.append(line)
+                size += len(line) + 1
+            if not self._lines:
+                self._flush_pending = False
+                self._timer.stop()
+        if lines:
+            self.output.appendPlainText("\n".join(lines))
+
+
+class _QPythonConsoleStream(object):
+    """File-like object that streams one thread's output to the console.
+
+    Output written from the interpreter's thread is sent to the console's
+    output buffer one complete line at a time.  Output written from any
+    other thread goes to the 'fallback' stream.
+    """
+
+    def __init__(self,interpreter,fallback):
+        self.interpreter = interpreter
+        self.fallback = fallback
+        self._partial = ""
+
+    def write(self,data):
+        if thread.get_ident() != self.interpreter.thread_id:
+            self.fallback.write(data)
+            return
+        data = self._partial + data
+        if "\n" not in data:
+            self._partial = data
+        else:
+            (lines,self._partial) = data.rsplit("\n",1)
+            self.interpreter.write(lines + "\n")
+
+    def writelines(self,lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if thread.get_ident() != self.interpreter.thread_id:
+            self.fallback.flush()
+        elif self._partial:
+            self.interpreter.write(self._partial)
+            self._partial = ""
+
 
 class _QPythonConsoleInterpreter(_InteractiveConsole):
-    """InteractiveConsole subclass that sends all output to the GUI."""
+    """InteractiveConsole subclass that sends all output to the GUI.
+
+    Use push_in_thread() to execute a line in a worker thread, with output
+    streamed to the GUI as it's produced and support for interrupting the
+    command via interrupt().
+    """
  
     def __init__(self,ui,locals=None):
         _InteractiveConsole.__init__(self,locals)
         self.ui = ui
+        self.thread_id = None
+        self._thread_lock = threading.Lock()
 
     def write(self,data):
         if data:
-            if data[-1] == "\n":
-                data = data[:-1]
-            self.ui.output.appendPlainText(data)
+            self.ui.output_buffer.write(data)
+
+    def push_in_thread(self,line):
+        """Push a line of input, from the thread that will execute it."""
+        thread_id = thread.get_ident()
+        with self._thread_lock:
+            self.thread_id = thread_id
+        try:
+            more = self.push(line)
+        except KeyboardInterrupt:
+            #  The interrupt arrived outside the user's code.
+            more = False
+            self.resetbuffer()
+            self.write("KeyboardInterrupt\n")
+        #  Make sure an interrupt can't arrive once we're finished; we
+        #  might get a pending one while trying, so keep trying.
+        while True:
+            try:
+                with self._thread_lock:
+                    self.thread_id = None
+                    _set_async_exc(thread_id,None)
+                return more
+            except KeyboardInterrupt:
+                pass
+
+    def interrupt(self):
+        """Raise KeyboardInterrupt in the command running in a thread.
+
+        Returns True if the command was interrupted, False if no command is
+        running or interrupts are not supported.
+        """
+        with self._thread_lock:
+            if self.thread_id is None:
+                return False
+            return _set_async_exc(self.thread_id,KeyboardInterrupt)
 
     def runsource(self,source,filename="<input>",symbol="single"):
+        if self.thread_id is not None:
+            return self._runsource_streaming(source,filename,symbol)
         old_stdout = sys.stdout
         old_stderr = sys.stderr
         sys.stdout = sys.stderr = collector = StringIO()
@@ -48,6 +220,22 @@ class _QPythonConsoleInterpreter(_InteractiveConsole):
         self.write(collector.getvalue())
         return more
 
+    def _runsource_streaming(self,source,filename,symbol):
+        old_stdout = sys.stdout
+        old_stderr = sys.stderr
+        sys.stdout = stdout = _QPythonConsoleStream(self,old_stdout)
+        sys.stderr = stderr = _QPythonConsoleStream(self,old_stderr)
+        try:
+            more = _InteractiveConsole.runsource(self,source,filename,symbol)
+        finally:
+            if sys.stdout is stdout:
+                sys.stdout = old_stdout
+            if sys.stderr is stderr:
+                sys.stderr = old_stderr
+            stdout.flush()
+            stderr.flush()
+        return more
+
 
 class _QPythonConsoleUI(object):
     """UI layout container for QPythonConsole."""
@@ -64,6 +252,7 @@ class _QPythonConsoleUI(object):
         fmt = QtGui.QTextCharFormat()
         fmt.setFontFixedPitch(True)
         self.output.setCurrentCharFormat(fmt)
+        self.output_buffer = _QPythonConsoleOutput(self.output)
         layout.addWidget(self.output)
         parent.layout().addLayout(layout)
         #  Input console, a prompt displated next to a lineedit
@@ -86,9 +275,17 @@ class QPythonConsole(QtGui.QWidget):
 
     You can customize the variables that are available in the shell by
     passing a dict as the "locals" argument.
+
+    Output is buffered and written to the display in batches, so printing
+    lots of output won't freeze the GUI.
+
+    If the "threaded" argument is true, commands are executed in a worker
+    thread rather than in the GUI thread.  While a command is running the
+    prompt shows "*** ", and pressing Ctrl+C in the input box (or calling
+    the interrupt() method) raises KeyboardInterrupt in the command.
     """
 
-    def __init__(self,parent=None,locals=None):
+    def __init__(self,parent=None,locals=None,threaded=False):
         super(QPythonConsole,self).__init__(parent)
         self.ui = _QPythonConsoleUI(self)
         self.interpreter = _QPythonConsoleInterpreter(self.ui,locals)
@@ -96,25 +293,61 @@ class QPythonConsole(QtGui.QWidget):
         self.ui.input.installEventFilter(self)
         self.history = []
         self.history_pos = 0
+        self.threaded = threaded
+        self.busy = False
+        self._worker = None
+        if threaded:
+            self._worker = WorkerPool("QPythonConsole",max_workers=1)
 
     def _on_enter_line(self):
+        if self.busy:
+            return
         line = self.ui.input.text()
         self.ui.input.setText("")
         self.interpreter.write(self.ui.prompt.text() + line)
-        more = self.interpreter.push(line)
         if line:
             self.history.append(line)
             self.history_pos = len(self.history)
             while len(self.history) > 100:
                 self.history = self.history[1:]
                 self.history_pos -= 1
+        if self.threaded:
+            self._set_busy(True)
+            future = self._worker.submit(self.interpreter.push_in_thread,line)
+            future.add_done_callback(self._on_push_done,in_main_thread=True)
+        else:
+            self._show_prompt(self.interpreter.push(line))
+
+    def _on_push_done(self,future):
+        self._set_busy(False)
+        self._show_prompt(future.exception() is None and future.result())
+
+    def _set_busy(self,busy):
+        self.busy = busy
+        self.ui.input.setReadOnly(busy)
+        if busy:
+            self.ui.prompt.setText("*** ")
+
+    def _show_prompt(self,more):
         if more:
             self.ui.prompt.setText("... ")
         else:
             self.ui.prompt.setText(">>> ")
+
+    def interrupt(self):
+        """Interrupt the running command, if any.
+
+        This only works for consoles created with threaded=True.  Returns
+        True if a command was interrupted.
+        """
+        return self.interpreter.interrupt()
         
     def eventFilter(self,obj,event):
         if event.type() == QtCore.QEvent.KeyPress:
+            if event.key() == QtCore.Qt.Key_C and self.busy:
+                if event.modifiers() & QtCore.Qt.ControlModifier:
+                    self.interrupt()
+                    return True
             if event.key() == QtCore.Qt.Key_Up:
                 self.go_history(-1)
             elif event.key() == QtCore.Qt.Key_Down:
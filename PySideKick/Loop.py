@@ -0,0 +1,282 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+"""
+
+PySideKick.Loop:  run asyncio coroutines on top of the Qt event loop
+====================================================================
+
+
+This module provides an implementation of the asyncio event loop that is
+driven by the Qt event loop, so that coroutines can run in the main GUI
+thread alongside ordinary Qt code.  It's built on the helpers in the
+PySideKick.Call module:
+
+    * call_soon:    dispatched via qCallAfter
+    * call_later:   scheduled on the shared timer wheel via qCallLater
+    * add_reader/add_writer:   implemented using QSocketNotifier
+
+To use it, install the event loop policy and then run the asyncio loop
+in place of the usual app.exec_() call:
+
+    asyncio.set_event_loop_policy(QAsyncioEventLoopPolicy())
+    loop = asyncio.get_event_loop()
+    loop.run_forever()
+
+There are also awaitable versions of the thread-hopping helpers from the
+PySideKick.Call module, which return asyncio futures:
+
+    * qAwaitInMainThread:   call function in the main GUI thread
+    * qAwaitInWorkerThread:   call function in a background worker thread
+
+The asyncio module is only available on Python 3.
+
+"""
+
+import sys
+import thread
+import threading
+import asyncio
+
+import PySideKick
+from PySideKick import QtCore
+from PySideKick import Call
+from PySideKick.Call import qCallLater, qCallInWorkerThread, Future
+
+
+def _make_handle(handle_class,*args,**kwds):
+    #  The 'context' argument to asyncio handles was added in Python 3.7.
+    if kwds.get("context") is None:
+        kwds.pop("context",None)
+    return handle_class(*args,**kwds)
+
+
+class QAsyncioEventLoop(asyncio.SelectorEventLoop):
+    """An asyncio event loop driven by the Qt event loop.
+
+    Running this loop executes a QEventLoop, so Qt events continue to be
+    processed while coroutines are running and vice-versa.  Since callbacks
+    are dispatched via qCallAfter, the loop must be run in the main thread.
+    """
+
+    def __init__(self,selector=None):
+        self._qt_loop = None
+        self._read_notifiers = {}
+        self._write_notifiers = {}
+        self._timer_calls = {}
+        super(QAsyncioEventLoop,self).__init__(selector)
+
+    def run_forever(self):
+        self._check_closed()
+        if self.is_running():
+            raise RuntimeError("This event loop is already running")
+        if asyncio.events._get_running_loop() is not None:
+            msg = "Cannot run the event loop while another loop is running"
+            raise RuntimeError(msg)
+        self._thread_id = thread.get_ident()
+        asyncio.events._set_running_loop(self)
+        if hasattr(sys,"get_asyncgen_hooks"):
+            old_hooks = sys.get_asyncgen_hooks()
+            sys.set_asyncgen_hooks(firstiter=self._asyncgen_firstiter_hook,
+                                   finalizer=self._asyncgen_finalizer_hook)
+        self._qt_loop = QtCore.QEventLoop()
+        try:
+            if not self._stopping:
+                self._qt_loop.exec_()
+        finally:
+            self._qt_loop = None
+            self._stopping = False
+            self._thread_id = None
+            asyncio.events._set_running_loop(None)
+            if hasattr(sys,"get_asyncgen_hooks"):
+                sys.set_asyncgen_hooks(*old_hooks)
+
+    def stop(self):
+        self._stopping = True
+        if self._qt_loop is not None:
+            Call._call_after_exempt(self._quit_qt_loop)
+
+    def _quit_qt_loop(self):
+        if self._qt_loop is not None:
+            self._qt_loop.quit()
+
+    def close(self):
+        if self.is_running():
+            raise RuntimeError("Cannot close a running event loop")
+        for call in self._timer_calls.values():
+            call.cancel()
+        self._timer_calls.clear()
+        super(QAsyncioEventLoop,self).close()
+        for fd in list(self._read_notifiers):
+            self._remove_reader(fd)
+        for fd in list(self._write_notifiers):
+            self._remove_writer(fd)
+
+    #  Scheduling of callbacks.
+
+    def call_soon(self,callback,*args,**kwds):
+        self._check_closed()
+        handle = _make_handle(asyncio.Handle,callback,args,self,**kwds)
+        Call._call_after_exempt(self._run_handle,handle)
+        return handle
+
+    #  qCallAfter is thread-safe, so there's nothing else to do here.
+    call_soon_threadsafe = call_soon
+
+    def call_later(self,delay,callback,*args,**kwds):
+        return self.call_at(self.time() + delay,callback,*args,**kwds)
+
+    def call_at(self,when,callback,*args,**kwds):
+        self._check_closed()
+        handle = _make_handle(asyncio.TimerHandle,when,callback,args,self,
+                              **kwds)
+        delay = max(0,when - self.time())
+        call = qCallLater(delay,self._run_timer_handle,handle)
+        #  TimerHandles compare equal by value, so key them by identity.
+        self._timer_calls[id(handle)] = call
+        return handle
+
+    def _add_callback(self,handle):
+        #  This is used by the base class to deliver signal handlers.
+        Call._call_after_exempt(self._run_handle,handle)
+
+    def _timer_handle_cancelled(self,handle):
+        call = self._timer_calls.pop(id(handle),None)
+        if call is not None:
+            call.cancel()
+
+    def _run_timer_handle(self,handle):
+        self._timer_calls.pop(id(handle),None)
+        self._run_handle(handle)
+
+    def _run_handle(self,handle):
+        if not handle._cancelled:
+            handle._run()
+
+    #  Watching of file descriptors.
+
+    def add_reader(self,fd,callback,*args):
+        self._ensure_fd_no_transport(fd)
+        self._add_reader(fd,callback,*args)
+
+    def remove_reader(self,fd):
+        self._ensure_fd_no_transport(fd)
+        return self._remove_reader(fd)
+
+    def add_writer(self,fd,callback,*args):
+        self._ensure_fd_no_transport(fd)
+        self._add_writer(fd,callback,*args)
+
+    def remove_writer(self,fd):
+        self._ensure_fd_no_transport(fd)
+        return self._remove_writer(fd)
+
+    def _add_reader(self,fd,callback,*args):
+        self._check_closed()
+        kind = QtCore.QSocketNotifier.Read
+        return self._add_notifier(self._read_notifiers,kind,fd,callback,args)
+
+    def _remove_reader(self,fd):
+        return self._remove_notifier(self._read_notifiers,fd)
+
+    def _add_writer(self,fd,callback,*args):
+        self._check_closed()
+        kind = QtCore.QSocketNotifier.Write
+        return self._add_notifier(self._write_notifiers,kind,fd,callback,args)
+
+    def _remove_writer(self,fd):
+        return self._remove_notifier(self._write_notifiers,fd)
+
+    def _add_notifier(self,notifiers,kind,fd,callback,args):
+        fd = _fileobj_to_fd(fd)
+        self._remove_notifier(notifiers,fd)
+        handle = _make_handle(asyncio.Handle,callback,args,self)
+        notifier = QtCore.QSocketNotifier(fd,kind)
+        def on_activated(socket):
+            self._run_handle(handle)
+        notifier.activated.connect(on_activated)
+        notifiers[fd] = (notifier,handle)
+        return handle
+
+    def _remove_notifier(self,notifiers,fd):
+        fd = _fileobj_to_fd(fd)
+        try:
+            (notifier,handle) = notifiers.pop(fd)
+        except KeyError:
+            return False
+        #  We might be inside the notifier's own signal handler, so it's
+        #  not safe to destroy it immediately.
+        notifier.setEnabled(False)
+        Call._call_after_exempt(notifier.deleteLater)
+        handle.cancel()
+        return True
+
+
+def _fileobj_to_fd(fileobj):
+    if isinstance(fileobj,int):
+        return fileobj
+    return int(fileobj.fileno())
+
+
+class QAsyncioEventLoopPolicy(asyncio.DefaultEventLoopPolicy):
+    """Event loop policy that uses a QAsyncioEventLoop in the main thread.
+
+    Other threads get the default event loop implementation.
+    """
+
+    def new_event_loop(self):
+        if threading.current_thread() is threading.main_thread():
+            return QAsyncioEventLoop()
+        return super(QAsyncioEventLoopPolicy,self).new_event_loop()
+
+
+def _wrap_future(future,loop=None):
+    """Wrap a PySideKick.Call.Future in an asyncio future.
+
+    The result of the Future is copied into the asyncio future from within
+    the asyncio loop's thread, and cancelling the asyncio future will try
+    to cancel the underlying Future.
+    """
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    aio_future = loop.create_future()
+    def copy_state(future):
+        if aio_future.cancelled():
+            return
+        if future.cancelled():
+            aio_future.cancel()
+        elif future.exception() is not None:
+            aio_future.set_exception(future.exception())
+        else:
+            aio_future.set_result(future.result())
+    def on_done(future):
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(copy_state,future)
+    def on_aio_done(aio_future):
+        if aio_future.cancelled():
+            future.cancel()
+    future.add_done_callback(on_done)
+    aio_future.add_done_callback(on_aio_done)
+    return aio_future
+
+
+def qAwaitInMainThread(func,*args,**kwds):
+    """Asynchronously call the given function in the main thread.
+
+    This helper is an awaitable version of qCallInMainThread.  It arranges
+    for the given function to be called in the main event loop, and returns
+    an asyncio future that will receive the result.
+    """
+    future = Future()
+    Call._call_after_exempt(future.call_function,func,*args,**kwds)
+    return _wrap_future(future)
+
+
+def qAwaitInWorkerThread(func,*args,**kwds):
+    """Asynchronously call the given function in a background worker thread.
+
+    This helper is an awaitable version of qCallInWorkerThread.  It arranges
+    for the given function to be called in a background worker thread, and
+    returns an asyncio future that will receive the result.
+    """
+    return _wrap_future(qCallInWorkerThread(func,*args,**kwds))
+
@@ -0,0 +1,248 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+"""
+
+PySideKick.Watchdog:  detect stalls in the main event loop
+==========================================================
+
+
+This module provides a watchdog that measures the responsiveness of the main
+event loop, and reports what the main thread was doing whenever the loop is
+blocked for too long.  A background watcher thread periodically sends a
+"heartbeat" call to the main thread via qCallAfter.  If the heartbeat isn't
+answered within 'threshold' seconds, the watcher captures the Python stack
+of the main thread and reports it as a stall.
+
+To start watching, just do this in the main thread:
+
+    qStartWatchdog(threshold=0.25)
+
+It can also be started from another thread, but only once the QApplication
+has been created.
+
+Each stall is logged as a warning, along with the stack of the main thread
+at the time the stall was detected.  The watchdog also keeps aggregated
+statistics, which can be retreived using qGetWatchdogStats():
+
+    * latency:  histogram summary of heartbeat round-trip times
+    * stalls:  number of stalls detected
+    * stall_time:  total time spent stalled, in seconds
+    * locations:  number of stalls seen at each code location
+    * recent_stalls:  details of the most recent stalls
+
+"""
+
+import sys
+import time
+import thread
+import logging
+import threading
+import traceback
+from collections import deque
+
+import PySideKick
+from PySideKick import QtCore, Call
+
+
+logger = logging.getLogger("PySideKick.Watchdog")
+
+
+class Stall(object):
+    """Record of a period during which the main event loop was blocked."""
+
+    def __init__(self,started,stack):
+        self.started = started
+        self.duration = None
+        self.stack = stack
+
+    @property
+    def location(self):
+        """Innermost code location in the captured stack, or None."""
+        if not self.stack:
+            return None
+        (filename,lineno,funcname,_) = self.stack[-1]
+        return "%s:%d in %s" % (filename,lineno,funcname)
+
+    def format_stack(self):
+        return "".join(traceback.format_list(self.stack))
+
+    def as_dict(self):
+        return {"started":self.started,"duration":self.duration,
+                "location":self.location,"stack":self.format_stack()}
+
+
+class StallWatchdog(object):
+    """Watcher thread that detects when the main event loop is blocked.
+
+    Every 'interval' seconds the watcher sends a heartbeat call to the main
+    thread.  If a heartbeat is still unanswered after 'threshold' seconds,
+    the stack of the main thread is captured and reported as a stall, by
+    logging a warning and calling 'callback' (if given) with a Stall object.
+    The stall's duration is filled in once the heartbeat is answered.
+
+    Only one stall is reported per heartbeat, so a single long freeze does
+    not produce a flood of reports.
+    """
+
+    def __init__(self,threshold=0.25,interval=0.1,callback=None,
+                 max_recent=20):
+        self.threshold = threshold
+        self.interval = interval
+        self.callback = callback
+        self.logger = logger
+        self.main_thread_id = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._sent_at = None
+        self._stall = None
+        self._latency = Call.Histogram()
+        self._num_stalls = 0
+        self._stall_time = 0.0
+        self._locations = {}
+        self._recent_stalls = deque(maxlen=max_recent)
+
+    def start(self):
+        """Start the watcher thread."""
+        if self._thread is not None:
+            return
+        self.main_thread_id = self._get_main_thread_id()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name="PySideKick-Watchdog")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self,wait=True):
+        """Stop the watcher thread."""
+        t = self._thread
+        if t is None:
+            return
+        self._thread = None
+        self._stop_event.set()
+        if wait and t is not threading.currentThread():
+            t.join()
+
+    def _get_main_thread_id(self):
+        if PySideKick.qIsMainThread():
+            return thread.get_ident()
+        #  Without an app, qCallInMainThread would wait forever.  But if
+        #  we're in python's main thread, that's where the app will live.
+        if QtCore.QCoreApplication.instance() is None:
+            if isinstance(threading.currentThread(),threading._MainThread):
+                return thread.get_ident()
+            msg = "the watchdog can only be started from a non-main thread"
+            msg += " once the QApplication has been created"
+            raise RuntimeError(msg)
+        return Call.qCallInMainThread(thread.get_ident)
+
+    def is_running(self):
+        return self._thread is not None
+
+    def _run(self):
+        #  Keep local references, since module globals may be cleared out
+        #  from under daemon threads at interpreter shutdown.
+        stop_event = self._stop_event
+        while not stop_event.isSet():
+            self._check()
+            stop_event.wait(self.interval)
+
+    def _check(self):
+        now = time.time()
+        with self._lock:
+            sent_at = self._sent_at
+            if sent_at is None:
+                self._sent_at = now
+            elif self._stall is not None:
+                return
+            elif now - sent_at < self.threshold:
+                return
+        if sent_at is None:
+            Call._call_after_exempt(self._heartbeat,now)
+            return
+        stall = Stall(sent_at,self._capture_stack())
+        with self._lock:
+            #  Don't report it if the heartbeat arrived in the meantime.
+            if self._sent_at != sent_at:
+                return
+            self._stall = stall
+            self._num_stalls += 1
+            location = stall.location
+            self._locations[location] = self._locations.get(location,0) + 1
+            self._recent_stalls.append(stall)
+        msg = "main event loop blocked for more than %.3fs:\n%s"
+        self.logger.warning(msg,now - sent_at,stall.format_stack())
+        if self.callback is not None:
+            try:
+                self.callback(stall)
+            except Exception:
+                self.logger.exception("exception in stall callback")
+
+    def _capture_stack(self):
+        frame = sys._current_frames().get(self.main_thread_id)
+        if frame is None:
+            return []
+        return traceback.extract_stack(frame)
+
+    def _heartbeat(self,sent_at):
+        now = time.time()
+        with self._lock:
+            if self._sent_at != sent_at:
+                return
+            self._sent_at = None
+            self._latency.add(now - sent_at)
+            stall = self._stall
+            self._stall = None
+            if stall is not None:
+                stall.duration = now - stall.started
+                self._stall_time += stall.duration
+
+    def stats(self):
+        """Get a dict of statistics about the responsiveness of the loop."""
+        with self._lock:
+            return {
+                "latency": self._latency.summary(),
+                "stalls": self._num_stalls,
+                "stall_time": self._stall_time,
+                "locations": dict(self._locations),
+                "recent_stalls": [s.as_dict() for s in self._recent_stalls],
+            }
+
+
+_watchdog = None
+
+
+def qStartWatchdog(threshold=0.25,interval=None,callback=None):
+    """Start watching the main event loop for stalls.
+
+    This returns the active StallWatchdog object; use the function
+    qGetWatchdogStats() to get a summary of the statistics collected so
+    far.  By default the loop is checked four times per 'threshold'.
+    """
+    global _watchdog
+    if interval is None:
+        interval = threshold / 4.0
+    qStopWatchdog()
+    _watchdog = StallWatchdog(threshold,interval,callback)
+    _watchdog.start()
+    return _watchdog
+
+
+def qStopWatchdog():
+    """Stop watching the main event loop for stalls."""
+    global _watchdog
+    if _watchdog is not None:
+        _watchdog.stop()
+        _watchdog = None
+
+
+def qGetWatchdogStats():
+    """Get a dict of statistics about stalls in the main event loop.
+
+    If the watchdog is not running, this returns an empty dict.
+    """
+    watchdog = _watchdog
+    if watchdog is None:
+        return {}
+    return watchdog.stats()
+
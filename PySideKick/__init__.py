@@ -15,6 +15,10 @@ widgets for building applications with PySide.  So far we have:
   * PySideKick.Console:   a simple interactive console to embed in your
                           application
 
+  * PySideKick.Loop:   an asyncio event loop driven by the Qt event loop
+
+  * PySideKick.Watchdog:   detect and report stalls in the main event loop
+
   * PySideKick.Hatchet:   a tool for hacking frozen PySide apps down to size,
                           by rebuilding PySide with a minimal set of classes
 
@@ -29,6 +33,7 @@ __version__ = "%d.%d.%d%s" % __ver_tuple__
 
 
 import thread
+import threading
 
 from PySide import QtCore, QtGui
 from PySide.QtCore import Qt
@@ -37,11 +42,32 @@ from PySide.QtCore import Qt
 #  Older versions of PySide don't expose the 'thread' attribute of QObject.
 #  In this case, assume the thread importing this module is the main thread.
 if hasattr(QtCore.QCoreApplication,"thread"):
+    #  Checking the thread is quite expensive, so the answer is cached in
+    #  a thread-local.  The cache is invalidated by bumping the generation
+    #  number whenever the application object is destroyed.
+    _thread_cache = threading.local()
+    _app_generation = 0
+    def _on_app_destroyed(*args):
+        global _app_generation
+        _app_generation += 1
     def qIsMainThread():
+        generation = _app_generation
+        try:
+            (cached_generation,result) = _thread_cache.is_main_thread
+        except AttributeError:
+            pass
+        else:
+            if cached_generation == generation:
+                return result
         app = QtCore.QCoreApplication.instance()
         if app is None:
             return False
-        return QtCore.QThread.currentThread() is app.thread()
+        if not getattr(app,"_PySideKick_watched",False):
+            app._PySideKick_watched = True
+            app.destroyed.connect(_on_app_destroyed)
+        result = QtCore.QThread.currentThread() is app.thread()
+        _thread_cache.is_main_thread = (generation,result)
+        return result
 else:
     _MAIN_THREAD_ID = thread.get_ident()
     def qIsMainThread():
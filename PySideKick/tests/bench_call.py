@@ -0,0 +1,335 @@
+"""
+
+PySideKick.tests.bench_call:  benchmarks for the PySideKick.Call helpers
+========================================================================
+
+
+This module measures the performance of the thread-hopping helpers in the
+PySideKick.Call module.  It's not part of the unittest suite; run it as a
+script, and it will write the results as JSON so that they can be compared
+across releases:
+
+    python -m PySideKick.tests.bench_call -o results.json
+
+The benchmarks run headless, using a QCoreApplication and the "offscreen"
+Qt platform plugin.  Each benchmark is repeated several times and both the
+minimum and the median are reported, since the minimum is the least noisy
+estimate of the true cost while the median shows the typical case.
+
+"""
+
+import os
+import sys
+import time
+import json
+import platform
+import threading
+
+import PySideKick
+from PySideKick import QtCore, qIsMainThread
+from PySideKick.Call import qCallAfter, qCallInMainThread, qCallUsing
+from PySideKick.Call import qCallInWorkerThread, qCallLater, wait_all
+
+
+def get_app():
+    os.environ.setdefault("QT_QPA_PLATFORM","offscreen")
+    app = QtCore.QCoreApplication.instance()
+    if app is None:
+        app = QtCore.QCoreApplication([])
+    return app
+
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    if n % 2:
+        return values[n // 2]
+    return (values[n // 2 - 1] + values[n // 2]) / 2.0
+
+
+def percentile(values,pct):
+    values = sorted(values)
+    idx = int(round((len(values) - 1) * pct / 100.0))
+    return values[idx]
+
+
+def run_event_loop(start):
+    """Run a nested event loop until the 'start' function calls done().
+
+    The 'start' function is called inside the loop, and receives a done()
+    function that will quit the loop.  This returns the elapsed time.
+    """
+    loop = QtCore.QEventLoop()
+    def done():
+        qCallAfter(loop.quit)
+    t_start = time.time()
+    qCallAfter(start,done)
+    loop.exec_()
+    return time.time() - t_start
+
+
+def bench_call_after(num_calls=10000,batch_calls=False):
+    """Time queuing and dispatching qCallAfter calls from the main thread."""
+    qCallAfter.configure(batch_calls=batch_calls)
+    state = {"count":0}
+    def start(done):
+        def callback():
+            state["count"] += 1
+            if state["count"] == num_calls:
+                done()
+        for _ in xrange(num_calls):
+            qCallAfter(callback)
+    try:
+        return run_event_loop(start)
+    finally:
+        qCallAfter.configure(batch_calls=False)
+
+
+def bench_call_after_threaded(num_calls=10000,batch_calls=False):
+    """Time dispatching qCallAfter calls queued by a producer thread."""
+    qCallAfter.configure(batch_calls=batch_calls)
+    state = {"count":0}
+    def start(done):
+        def callback():
+            state["count"] += 1
+            if state["count"] == num_calls:
+                done()
+        def produce():
+            for _ in xrange(num_calls):
+                qCallAfter(callback)
+        t = threading.Thread(target=produce)
+        t.daemon = True
+        t.start()
+    try:
+        return run_event_loop(start)
+    finally:
+        qCallAfter.configure(batch_calls=False)
+
+
+def bench_call_in_main_thread(num_threads=4,num_calls=250):
+    """Time qCallInMainThread round-trips from several concurrent threads.
+
+    This returns a list of the individual round-trip latencies.
+    """
+    latencies = []
+    lock = threading.Lock()
+    def noop():
+        pass
+    def start(done):
+        state = {"remaining":num_threads}
+        def worker():
+            my_latencies = []
+            for _ in xrange(num_calls):
+                t_start = time.time()
+                qCallInMainThread(noop)
+                my_latencies.append(time.time() - t_start)
+            with lock:
+                latencies.extend(my_latencies)
+                state["remaining"] -= 1
+                if state["remaining"] == 0:
+                    done()
+        for _ in xrange(num_threads):
+            t = threading.Thread(target=worker)
+            t.daemon = True
+            t.start()
+    run_event_loop(start)
+    return latencies
+
+
+def bench_worker_thread(num_tasks=1000):
+    """Time running trivial tasks via qCallInWorkerThread."""
+    def noop():
+        pass
+    t_start = time.time()
+    futures = [qCallInWorkerThread(noop) for _ in xrange(num_tasks)]
+    wait_all(futures)
+    return time.time() - t_start
+
+
+def bench_raw_thread(num_tasks=1000):
+    """Time running trivial tasks in a new threading.Thread each.
+
+    This is the baseline against which qCallInWorkerThread is compared.
+    """
+    def noop():
+        pass
+    t_start = time.time()
+    threads = []
+    for _ in xrange(num_tasks):
+        t = threading.Thread(target=noop)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    return time.time() - t_start
+
+
+def bench_call_later(num_calls=10000):
+    """Time scheduling and then cancelling calls with qCallLater.
+
+    This returns a tuple of (schedule time, cancel time).
+    """
+    def noop():
+        pass
+    t_start = time.time()
+    calls = [qCallLater(60,noop) for _ in xrange(num_calls)]
+    t_scheduled = time.time()
+    for call in calls:
+        call.cancel()
+    t_cancelled = time.time()
+    return (t_scheduled - t_start,t_cancelled - t_scheduled)
+
+
+def uncached_is_main_thread():
+    """The uncached version of qIsMainThread, for comparison."""
+    app = QtCore.QCoreApplication.instance()
+    if app is None:
+        return False
+    return QtCore.QThread.currentThread() is app.thread()
+
+
+def bench_is_main_thread(num_calls=10000,check=qIsMainThread):
+    """Time repeated checks of whether we're in the main thread."""
+    t_start = time.time()
+    for _ in xrange(num_calls):
+        check()
+    return time.time() - t_start
+
+
+def bench_call_using(num_calls=10000,decorate=True):
+    """Time calling a qCallUsing(qCallInMainThread) function inline.
+
+    If 'decorate' is false, the undecorated function is called instead to
+    give a baseline for the overhead of the decorator.
+    """
+    def noop():
+        pass
+    if decorate:
+        noop = qCallUsing(qCallInMainThread)(noop)
+    t_start = time.time()
+    for _ in xrange(num_calls):
+        noop()
+    return time.time() - t_start
+
+
+def summarize(times,num_ops):
+    """Summarize repeated timings of a benchmark that ran num_ops operations.
+
+    Times are reported in microseconds per operation.
+    """
+    per_op = [t * 1e6 / num_ops for t in times]
+    return {
+        "num_ops": num_ops,
+        "min_us": min(per_op),
+        "median_us": median(per_op),
+        "ops_per_sec": num_ops / min(times),
+    }
+
+
+def summarize_latencies(latencies):
+    """Summarize a list of individual latencies, in microseconds."""
+    latencies = [t * 1e6 for t in latencies]
+    return {
+        "num_ops": len(latencies),
+        "mean_us": sum(latencies) / len(latencies),
+        "p50_us": percentile(latencies,50),
+        "p99_us": percentile(latencies,99),
+        "max_us": max(latencies),
+    }
+
+
+def run_benchmarks(repeat=5,num_calls=10000,num_threads=4,num_tasks=1000):
+    """Run all the benchmarks, returning a dict of results."""
+    get_app()
+    results = {}
+    for batch_calls in (False,True):
+        suffix = "batched" if batch_calls else "unbatched"
+        times = [bench_call_after(num_calls,batch_calls)
+                 for _ in xrange(repeat)]
+        results["qCallAfter.main." + suffix] = summarize(times,num_calls)
+        times = [bench_call_after_threaded(num_calls,batch_calls)
+                 for _ in xrange(repeat)]
+        results["qCallAfter.thread." + suffix] = summarize(times,num_calls)
+    calls_per_thread = max(1,num_calls // (num_threads * 10))
+    latencies = []
+    for _ in xrange(repeat):
+        latencies.extend(bench_call_in_main_thread(num_threads,
+                                                   calls_per_thread))
+    results["qCallInMainThread.roundtrip"] = summarize_latencies(latencies)
+    #  Warm up the pool so we measure dispatch, not thread creation.
+    bench_worker_thread(num_tasks)
+    times = [bench_worker_thread(num_tasks) for _ in xrange(repeat)]
+    results["qCallInWorkerThread.pool"] = summarize(times,num_tasks)
+    times = [bench_raw_thread(num_tasks) for _ in xrange(repeat)]
+    results["qCallInWorkerThread.baseline"] = summarize(times,num_tasks)
+    times = [bench_call_later(num_calls) for _ in xrange(repeat)]
+    results["qCallLater.schedule"] = summarize([t[0] for t in times],num_calls)
+    results["qCallLater.cancel"] = summarize([t[1] for t in times],num_calls)
+    for (name,check) in (("cached",qIsMainThread),
+                         ("uncached",uncached_is_main_thread)):
+        times = [bench_is_main_thread(num_calls,check)
+                 for _ in xrange(repeat)]
+        results["qIsMainThread." + name] = summarize(times,num_calls)
+    for (name,decorate) in (("inline",True),("baseline",False)):
+        times = [bench_call_using(num_calls,decorate)
+                 for _ in xrange(repeat)]
+        results["qCallUsing." + name] = summarize(times,num_calls)
+    return results
+
+
+def get_metadata(**params):
+    """Get a dict describing the environment in which benchmarks were run."""
+    try:
+        qt_version = QtCore.qVersion()
+    except AttributeError:
+        qt_version = None
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "pysidekick": PySideKick.__version__,
+        "qt": qt_version,
+        "timestamp": int(time.time()),
+        "params": params,
+    }
+
+
+if __name__ == "__main__":
+    import optparse
+    usage = "usage: python -m PySideKick.tests.bench_call [options]"
+    op = optparse.OptionParser(usage=usage)
+    op.add_option("-o","--output",default=None,
+                  help="write JSON results to the given file")
+    op.add_option("-r","--repeat",type="int",default=5,
+                  help="number of times to repeat each benchmark")
+    op.add_option("-n","--num-calls",type="int",default=10000,
+                  dest="num_calls",
+                  help="number of calls made by each benchmark")
+    op.add_option("-t","--num-threads",type="int",default=4,
+                  dest="num_threads",
+                  help="number of threads for qCallInMainThread")
+    op.add_option("","--num-tasks",type="int",default=1000,
+                  dest="num_tasks",
+                  help="number of tasks for qCallInWorkerThread")
+    (opts,args) = op.parse_args()
+    params = {
+        "repeat": opts.repeat,
+        "num_calls": opts.num_calls,
+        "num_threads": opts.num_threads,
+        "num_tasks": opts.num_tasks,
+    }
+    results = run_benchmarks(**params)
+    output = {"metadata":get_metadata(**params),"results":results}
+    data = json.dumps(output,indent=2,sort_keys=True,
+                      separators=(",",": "))
+    if opts.output is None:
+        print data
+    else:
+        f = open(opts.output,"w")
+        try:
+            f.write(data)
+            f.write("\n")
+        finally:
+            f.close()
+    sys.exit(0)
@@ -0,0 +1,1054 @@
+
+import unittest
+
+import time
+import json
+import StringIO
+import threading
+
+import PySideKick
+from PySideKick import QtCore
+from PySideKick import Call
+from PySideKick.Call import WorkerPool, qWorkerPool, qCallInWorkerThread
+from PySideKick.Call import SerialQueue, qSerialQueue
+from PySideKick.Call import qStreamInWorkerThread, qParallelMap
+from PySideKick.Call import TaskGroup, TaskGroupError
+from PySideKick.Call import qCallWhenIdle, PRIORITY_URGENT
+from PySideKick.Call import qCallLater, qCallInMainThread
+from PySideKick.Call import qCallManyInMainThread, qMainThreadBatch
+from PySideKick.Call import qCallInThread, qCallInThreadAndWait
+from PySideKick.Call import Future, wait_any, wait_all
+from PySideKick.Call import CancelledError, TimeoutError
+from PySideKick.Call import CancelToken, qCurrentCancelToken
+from PySideKick.Call import qCallUsing, qCoalesce, qDebounce, qThrottle
+from PySideKick.Call import qCached
+from PySideKick.Call import qCallInWorkerProcess, qMapInWorkerProcess
+
+
+def get_app():
+    app = QtCore.QCoreApplication.instance()
+    if app is None:
+        app = QtCore.QCoreApplication([])
+    return app
+
+
+def square(x):
+    return x * x
+
+
+def make_lock(*args):
+    return threading.Lock()
+
+
+def process_events_until(predicate,timeout=5):
+    end = time.time() + timeout
+    while not predicate() and time.time() < end:
+        QtCore.QCoreApplication.processEvents()
+        time.sleep(0.001)
+    return predicate()
+
+
+class TestCallAfter(unittest.TestCase):
+
+    def setUp(self):
+        self.app = get_app()
+        #  Calling from the main thread ensures qCallAfter is bootstrapped.
+        Call.qCallAfter(lambda: None)
+        self.batch_calls = Call.qCallAfter.batch_calls
+        self.time_budget = Call.qCallAfter.time_budget
+        self.max_urgent_streak = Call.qCallAfter.max_urgent_streak
+
+    def tearDown(self):
+        Call.qCallAfter.configure(batch_calls=self.batch_calls,
+                                  time_budget=self.time_budget,
+                                  max_urgent_streak=self.max_urgent_streak)
+
+    def _call_from_thread(self,n,output):
+        def producer():
+            for i in xrange(n):
+                Call.qCallAfter(output.append,i)
+        t = threading.Thread(target=producer)
+        t.start()
+        t.join()
+
+    def test_calls_run_in_order(self):
+        output = []
+        self._call_from_thread(100,output)
+        process_events_until(lambda: len(output) == 100)
+        self.assertEquals(output,range(100))
+
+    def test_batched_calls_coalesce_wakeups(self):
+        Call.qCallAfter.configure(batch_calls=True)
+        process_events_until(lambda: Call.qCallAfter.func_queue.empty())
+        posted = []
+        postEvent = Call.qCallAfter._postEvent
+        Call.qCallAfter._postEvent = lambda: posted.append(postEvent())
+        try:
+            output = []
+            self._call_from_thread(1000,output)
+            self.assertEquals(len(posted),1)
+            process_events_until(lambda: len(output) == 1000)
+            self.assertEquals(output,range(1000))
+        finally:
+            del Call.qCallAfter._postEvent
+
+    def test_batched_calls_yield_when_out_of_time(self):
+        Call.qCallAfter.configure(batch_calls=True,time_budget=0)
+        output = []
+        self._call_from_thread(10,output)
+        QtCore.QCoreApplication.processEvents()
+        self.assertTrue(len(output) < 10)
+        process_events_until(lambda: len(output) == 10)
+        self.assertEquals(output,range(10))
+
+    def test_urgent_calls_run_first(self):
+        output = []
+        process_events_until(lambda: not Call.qCallAfter._hasCalls())
+        for i in xrange(3):
+            Call.qCallAfter(output.append,("normal",i))
+        for i in xrange(3):
+            Call.qCallAfter.callWithPriority(PRIORITY_URGENT,
+                                             output.append,("urgent",i))
+        process_events_until(lambda: len(output) == 6)
+        self.assertEquals([o[0] for o in output],["urgent"]*3 + ["normal"]*3)
+
+    def test_normal_calls_are_not_starved(self):
+        Call.qCallAfter.configure(batch_calls=True,max_urgent_streak=2)
+        process_events_until(lambda: not Call.qCallAfter._hasCalls())
+        output = []
+        Call.qCallAfter(output.append,"normal")
+        for i in xrange(5):
+            Call.qCallAfter.callWithPriority(PRIORITY_URGENT,
+                                             output.append,"urgent")
+        process_events_until(lambda: len(output) == 6)
+        self.assertEquals(output.index("normal"),2)
+
+    def test_qCallWhenIdle(self):
+        output = []
+        qCallWhenIdle(output.append,"idle")
+        for i in xrange(3):
+            Call.qCallAfter(output.append,i)
+        process_events_until(lambda: len(output) == 4)
+        self.assertEquals(output,[0,1,2,"idle"])
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def test_qCallInWorkerThread(self):
+        future = qCallInWorkerThread(lambda x: x * 2,21)
+        self.assertEquals(future.get_result(),42)
+        def fail():
+            raise ValueError("oops")
+        future = qCallInWorkerThread(fail)
+        self.assertRaises(ValueError,future.get_result)
+
+    def test_pool_size_is_bounded(self):
+        pool = WorkerPool(max_workers=2)
+        lock = threading.Lock()
+        running = [0,0]
+        def task():
+            with lock:
+                running[0] += 1
+                running[1] = max(running[0],running[1])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+        futures = [pool.submit(task) for _ in xrange(20)]
+        for future in futures:
+            future.get_result()
+        self.assertTrue(running[1] <= 2)
+        self.assertTrue(pool._num_spawned <= 2)
+        pool.shutdown()
+        self.assertEquals(pool._num_workers,0)
+
+    def test_idle_workers_are_reaped(self):
+        pool = WorkerPool(max_workers=4,idle_timeout=0.05)
+        futures = [pool.submit(time.sleep,0.01) for _ in xrange(4)]
+        for future in futures:
+            future.get_result()
+        time.sleep(0.2)
+        self.assertEquals(pool._num_workers,0)
+        self.assertEquals(pool.submit(lambda: 7).get_result(),7)
+        pool.shutdown()
+
+    def test_shutdown_with_full_queue(self):
+        pool = WorkerPool(max_workers=1,max_queue=1)
+        release = threading.Event()
+        running = pool.submit(release.wait,5)
+        queued = pool.submit(square,3)
+        t = threading.Thread(target=pool.shutdown)
+        t.daemon = True
+        t.start()
+        time.sleep(0.01)
+        release.set()
+        t.join(5)
+        self.assertFalse(t.isAlive())
+        self.assertTrue(running.get_result())
+        self.assertEqual(queued.get_result(),9)
+        self.assertEqual(pool._num_workers,0)
+
+    def test_named_pools(self):
+        pool = qWorkerPool("test-named",max_workers=1)
+        self.assertTrue(qWorkerPool("test-named") is pool)
+        self.assertTrue(qWorkerPool() is not pool)
+        self.assertEquals(pool.max_workers,1)
+        self.assertEquals(pool(lambda: threading.currentThread().name)
+                              .get_result()[:10],"test-named")
+
+    def test_cancel_tokens(self):
+        pool = WorkerPool(max_workers=1)
+        started = threading.Event()
+        def spin():
+            token = qCurrentCancelToken()
+            started.set()
+            while True:
+                token.check()
+                time.sleep(0.001)
+        running = pool.submit_task(spin)
+        queued = pool.submit_task(lambda: 42)
+        started.wait(5)
+        self.assertTrue(queued.cancel())
+        self.assertFalse(running.cancel())
+        self.assertTrue(running.token.is_cancelled())
+        self.assertRaises(CancelledError,running.get_result,5)
+        self.assertRaises(CancelledError,queued.get_result,5)
+        self.assertEqual(qCurrentCancelToken(),None)
+        #  A shared token drops all the queued tasks that use it.
+        token = CancelToken()
+        release = threading.Event()
+        blocker = pool.submit(release.wait,5)
+        futures = [pool.submit_task(square,(i,),token=token)
+                   for i in xrange(5)]
+        token.cancel()
+        release.set()
+        blocker.get_result()
+        for future in futures:
+            self.assertRaises(CancelledError,future.get_result,5)
+        pool.shutdown()
+
+    def test_deadlines(self):
+        pool = WorkerPool(max_workers=1)
+        blocker = pool.submit(time.sleep,0.05)
+        future = pool.submit_task(square,(3,),timeout=0.01)
+        self.assertRaises(CancelledError,future.get_result,5)
+        blocker = pool.submit(time.sleep,0.05)
+        self.assertRaises(TimeoutError,blocker.get_result,0.001)
+        future = pool.submit_task(square,(3,),timeout=5)
+        self.assertEqual(future.get_result(5),9)
+        self.assertTrue(future.token.remaining() > 0)
+        pool.shutdown()
+
+    def test_serial_queues(self):
+        pool = WorkerPool(max_workers=4)
+        queues = [SerialQueue(i,pool,max_batch=3) for i in xrange(2)]
+        lock = threading.Lock()
+        running = {}
+        results = {0:[],1:[]}
+        def task(key,i):
+            with lock:
+                running[key] = running.get(key,0) + 1
+                self.assertEqual(running[key],1)
+            time.sleep(0.001)
+            results[key].append(i)
+            with lock:
+                running[key] -= 1
+        futures = []
+        for i in xrange(20):
+            for (key,queue) in enumerate(queues):
+                futures.append(queue.submit(task,key,i))
+        wait_all(futures,5)
+        for future in futures:
+            self.assertEqual(future.get_result(),None)
+        self.assertEqual(results,{0:range(20),1:range(20)})
+        self.assertEqual(queues[0].num_pending(),0)
+        pool.shutdown()
+
+    def test_serial_queue_recovers_from_pool_errors(self):
+        pool = WorkerPool(max_workers=1)
+        pool.shutdown()
+        queue = SerialQueue("test-errors",pool)
+        self.assertRaises(RuntimeError,queue.submit,square,2)
+        self.assertEqual(queue.num_pending(),0)
+        queue.pool = WorkerPool(max_workers=1)
+        self.assertEqual(queue.submit(square,3).get_result(5),9)
+        queue.pool.shutdown()
+
+    def test_qSerialQueue(self):
+        self.assertTrue(qSerialQueue("test-serial") is
+                        qSerialQueue("test-serial"))
+        calls = []
+        @qCallUsing(qSerialQueue("test-serial"))
+        def record(i):
+            calls.append(i)
+            return i
+        futures = [record(i) for i in xrange(10)]
+        self.assertEqual([f.get_result(5) for f in futures],range(10))
+        self.assertEqual(calls,range(10))
+
+
+class TestStreaming(unittest.TestCase):
+
+    def setUp(self):
+        self.app = get_app()
+        Call.qCallAfter(lambda: None)
+
+    def test_stream_in_batches(self):
+        batches = []
+        def consumer(batch):
+            self.assertTrue(Call.qIsMainThread())
+            batches.append(batch)
+        future = qStreamInWorkerThread(xrange,consumer,(25,),max_batch=10,
+                                       max_delay=60)
+        process_events_until(lambda: len(batches) == 3)
+        self.assertEqual(future.get_result(5),25)
+        self.assertEqual(batches,[range(10),range(10,20),range(20,25)])
+
+    def test_backpressure(self):
+        produced = []
+        def produce():
+            for i in xrange(100):
+                produced.append(i)
+                yield i
+        batches = []
+        future = qStreamInWorkerThread(produce,batches.append,max_batch=5,
+                                       max_pending=2)
+        time.sleep(0.2)
+        #  The worker can run at most max_pending batches ahead of us.
+        self.assertTrue(len(produced) <= 5 * 3 + 1)
+        process_events_until(future.done)
+        QtCore.QCoreApplication.processEvents()
+        self.assertEqual(future.get_result(),100)
+        self.assertEqual(sum(batches,[]),range(100))
+
+    def test_cancel_stream(self):
+        closed = []
+        def produce():
+            try:
+                i = 0
+                while True:
+                    yield i
+                    i += 1
+            finally:
+                closed.append(True)
+        batches = []
+        def consumer(batch):
+            batches.append(batch)
+            raise ValueError("stop")
+        messages = []
+        logger = Call.logger
+        Call.logger = FakeLogger(messages)
+        try:
+            future = qStreamInWorkerThread(produce,consumer,max_batch=5)
+            process_events_until(future.done)
+        finally:
+            Call.logger = logger
+        self.assertRaises(CancelledError,future.get_result,5)
+        self.assertEqual(closed,[True])
+        self.assertEqual(len(batches),1)
+        self.assertEqual(messages,["exception consuming streamed items"])
+
+    def test_parallel_map(self):
+        self.assertEqual(list(qParallelMap(square,xrange(10))),
+                         [x * x for x in xrange(10)])
+        self.assertEqual(list(qParallelMap(square,[])),[])
+        def slow_square(x):
+            time.sleep(0.01 * (10 - x))
+            return x * x
+        results = list(qParallelMap(slow_square,xrange(10),chunksize=3,
+                                    ordered=False))
+        self.assertEqual(sorted(results),[x * x for x in xrange(10)])
+        self.assertNotEqual(results,[x * x for x in xrange(10)])
+
+    def test_parallel_map_bounds_work_in_flight(self):
+        pool = WorkerPool(max_workers=2)
+        consumed = []
+        def items():
+            for i in xrange(100):
+                consumed.append(i)
+                yield i
+        results = qParallelMap(square,items(),chunksize=5,max_in_flight=2,
+                               pool=pool)
+        self.assertEqual(results.next(),0)
+        self.assertTrue(len(consumed) <= 5 * 3 + 1)
+        self.assertEqual(list(results),[x * x for x in xrange(1,100)])
+        pool.shutdown()
+
+    def test_parallel_map_progress_and_errors(self):
+        progress = []
+        results = list(qParallelMap(square,xrange(10),chunksize=4,
+                                    progress=progress.append))
+        process_events_until(lambda: len(progress) == 3)
+        self.assertEqual(len(progress),3)
+        self.assertEqual(progress[-1],10)
+        self.assertEqual(progress,sorted(progress))
+        def check(x):
+            if x == 5:
+                raise ValueError(x)
+            return x
+        self.assertRaises(ValueError,list,qParallelMap(check,xrange(10)))
+
+    def test_task_group(self):
+        with TaskGroup() as group:
+            for i in xrange(5):
+                group.submit(square,i)
+        self.assertEqual(group.results(),[0,1,4,9,16])
+        self.assertEqual(group.exceptions(),[])
+
+    def test_task_group_failure_cancels_siblings(self):
+        pool = WorkerPool(max_workers=2)
+        started = threading.Event()
+        def spin():
+            started.set()
+            token = Call.qCurrentCancelToken()
+            while True:
+                token.check()
+                time.sleep(0.001)
+        def fail():
+            started.wait(5)
+            raise ValueError("oops")
+        try:
+            with TaskGroup(pool) as group:
+                spinner = group.submit(spin)
+                group.submit(fail)
+                queued = [group.submit(square,i) for i in xrange(5)]
+        except TaskGroupError, e:
+            self.assertEqual(len(e.exceptions),1)
+            self.assertTrue(isinstance(e.exceptions[0],ValueError))
+        else:
+            self.fail("TaskGroupError not raised")
+        self.assertRaises(CancelledError,spinner.result)
+        self.assertTrue(any(f.cancelled() for f in queued))
+        pool.shutdown()
+
+    def test_task_group_failure_in_last_task(self):
+        #  Delay the group's bookkeeping for each task, so that any waiter
+        #  woken by the futures themselves would check for failures early.
+        class SlowTaskGroup(TaskGroup):
+            def _on_task_done(self,future):
+                time.sleep(0.05)
+                super(SlowTaskGroup,self)._on_task_done(future)
+        def fail():
+            time.sleep(0.05)
+            raise ValueError("oops")
+        group = SlowTaskGroup()
+        try:
+            with group:
+                group.submit(square,2)
+                group.submit(fail)
+        except TaskGroupError, e:
+            self.assertEqual(len(e.exceptions),1)
+            self.assertTrue(isinstance(e.exceptions[0],ValueError))
+        else:
+            self.fail("TaskGroupError not raised")
+        self.assertRaises(TaskGroupError,group.results)
+
+    def test_task_group_callback(self):
+        done = []
+        group = TaskGroup(on_done=done.append)
+        group.submit(square,3)
+        group.submit(square,4)
+        group.close()
+        self.assertRaises(RuntimeError,group.submit,square,5)
+        process_events_until(lambda: done)
+        self.assertEqual(done,[group])
+        self.assertEqual(group.results(),[9,16])
+        #  A group with no tasks is done as soon as it's closed.
+        group = TaskGroup(on_done=done.append)
+        group.close()
+        process_events_until(lambda: len(done) == 2)
+        self.assertEqual(done[1],group)
+
+
+class TestCallLater(unittest.TestCase):
+
+    def setUp(self):
+        self.app = get_app()
+        Call.qCallAfter(lambda: None)
+
+    def test_calls_happen_in_order(self):
+        output = []
+        num_threads = threading.activeCount()
+        for i in (5,2,4,1,3):
+            qCallLater(i * 0.02,output.append,i)
+        self.assertEquals(threading.activeCount(),num_threads)
+        process_events_until(lambda: len(output) == 5)
+        self.assertEquals(output,[1,2,3,4,5])
+
+    def test_cancel_and_reschedule(self):
+        output = []
+        c1 = qCallLater(0.01,output.append,1)
+        c2 = qCallLater(0.02,output.append,2)
+        c3 = qCallLater(0.03,output.append,3)
+        c1.cancel()
+        c2.reschedule(0.05)
+        self.assertFalse(c1.is_pending())
+        self.assertTrue(c2.is_pending())
+        process_events_until(lambda: len(output) == 2)
+        self.assertEquals(output,[3,2])
+        self.assertFalse(c2.is_pending())
+
+    def test_long_intervals_wrap_around_the_wheel(self):
+        wheel = Call.TimerWheel(resolution=0.001,num_slots=8)
+        output = []
+        for i in (3,1,2):
+            handle = Call.ScheduledCall(wheel,output.append,(i,),{})
+            wheel.schedule(handle,i * 0.02)
+        process_events_until(lambda: len(output) == 3)
+        self.assertEquals(output,[1,2,3])
+        self.assertFalse(wheel._running)
+
+
+class TestFuture(unittest.TestCase):
+
+    def setUp(self):
+        self.app = get_app()
+        Call.qCallAfter(lambda: None)
+
+    def test_result_and_exception(self):
+        f = Future()
+        self.assertRaises(TimeoutError,f.result,0.01)
+        self.assertFalse(f.done())
+        f.set_result(42)
+        self.assertTrue(f.done())
+        self.assertEquals(f.result(0),42)
+        self.assertEquals(f.exception(),None)
+        f = Future()
+        f.call_function(int,"oops")
+        self.assertRaises(ValueError,f.result)
+        self.assertTrue(isinstance(f.exception(),ValueError))
+
+    def test_cancel(self):
+        f = Future()
+        self.assertTrue(f.cancel())
+        self.assertTrue(f.cancelled())
+        self.assertRaises(CancelledError,f.result)
+        called = []
+        f.call_function(called.append,1)
+        self.assertEquals(called,[])
+        f = Future()
+        f.set_running_or_notify_cancel()
+        self.assertTrue(f.running())
+        self.assertFalse(f.cancel())
+
+    def test_add_done_callback(self):
+        done = []
+        f = Future()
+        f.add_done_callback(done.append)
+        self.assertEquals(done,[])
+        f.set_result(1)
+        self.assertEquals(done,[f])
+        f.add_done_callback(done.append)
+        self.assertEquals(done,[f,f])
+
+    def test_add_done_callback_in_main_thread(self):
+        threads = []
+        def callback(future):
+            threads.append(threading.currentThread())
+        f = qCallInWorkerThread(time.sleep,0.01)
+        f.add_done_callback(callback,in_main_thread=True)
+        process_events_until(lambda: threads)
+        self.assertEquals(threads,[threading.currentThread()])
+
+    def test_wait_any_and_wait_all(self):
+        fs = [qCallInWorkerThread(time.sleep,i * 0.05) for i in xrange(3)]
+        (done,not_done) = wait_any(fs)
+        self.assertTrue(fs[0] in done)
+        self.assertTrue(fs[2] in not_done)
+        (done,not_done) = wait_all(fs,timeout=0)
+        self.assertTrue(fs[2] in not_done)
+        (done,not_done) = wait_all(fs)
+        self.assertEquals(done,set(fs))
+        self.assertEquals(not_done,set())
+
+    def test_qCallInMainThread(self):
+        self.assertEquals(qCallInMainThread(lambda: 42),42)
+        result = []
+        def worker():
+            result.append(qCallInMainThread(threading.currentThread))
+        t = threading.Thread(target=worker)
+        t.start()
+        process_events_until(lambda: result)
+        t.join()
+        self.assertEquals(result,[threading.currentThread()])
+
+    def test_qCallManyInMainThread(self):
+        calls = [threading.currentThread,(square,(3,)),
+                 (int,("10",),{"base":2})]
+        result = []
+        error = []
+        def worker():
+            result.append(qCallManyInMainThread(calls))
+            try:
+                qCallManyInMainThread([(int,("x",)),error.append])
+            except ValueError:
+                error.append("raised")
+        t = threading.Thread(target=worker)
+        t.start()
+        process_events_until(lambda: error)
+        t.join()
+        self.assertEqual(result,[[threading.currentThread(),9,2]])
+        self.assertEqual(error,["raised"])
+
+    def test_qMainThreadBatch(self):
+        result = []
+        def worker():
+            with qMainThreadBatch() as batch:
+                batch.add(threading.currentThread)
+                batch.add(square,4)
+                self.assertEqual(batch.results,[])
+            result.extend(batch.results)
+        t = threading.Thread(target=worker)
+        t.start()
+        process_events_until(lambda: result)
+        t.join()
+        self.assertEqual(result,[threading.currentThread(),16])
+        #  Calls are discarded if the block exits with an error.
+        batch = qMainThreadBatch()
+        try:
+            with batch:
+                batch.add(result.append,"oops")
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertEqual(batch.calls,[])
+        self.assertEqual(batch.results,[])
+
+    def test_qCallInThread(self):
+        qthread = QtCore.QThread()
+        qthread.start()
+        try:
+            current = QtCore.QThread.currentThread
+            futures = [qCallInThread(qthread,current) for _ in xrange(5)]
+            for future in futures:
+                self.assertTrue(future.result(5) is qthread)
+            self.assertTrue(qCallInThreadAndWait(qthread,current) is qthread)
+            #  Calling in the current thread just calls the function.
+            me = current()
+            self.assertTrue(qCallInThreadAndWait(me,current) is me)
+            order = []
+            futures = [qCallInThread(qthread,order.append,i)
+                       for i in xrange(10)]
+            wait_all(futures,5)
+            self.assertEqual(order,range(10))
+        finally:
+            qthread.quit()
+            qthread.wait()
+        self.assertFalse(qthread in Call._THREAD_DISPATCHERS)
+
+    def test_qIsMainThread_is_cached(self):
+        self.assertTrue(Call.qIsMainThread())
+        result = []
+        def worker():
+            result.append(Call.qIsMainThread())
+        t = threading.Thread(target=worker)
+        t.start()
+        t.join()
+        self.assertEqual(result,[False])
+        #  The cached value is used until the app generation changes.
+        cache = PySideKick._thread_cache
+        cache.is_main_thread = (PySideKick._app_generation,False)
+        try:
+            self.assertFalse(Call.qIsMainThread())
+            PySideKick._on_app_destroyed()
+            self.assertTrue(Call.qIsMainThread())
+        finally:
+            del cache.is_main_thread
+
+    def test_qCallUsing_inline_fast_path(self):
+        calls = []
+        inline = [True]
+        def helper(func,*args,**kwds):
+            calls.append(func)
+            return func(*args,**kwds)
+        helper.can_call_inline = lambda: inline[0]
+        @qCallUsing(helper)
+        def double(x):
+            return x * 2
+        self.assertEqual(double(2),4)
+        self.assertEqual(calls,[])
+        inline[0] = False
+        self.assertEqual(double(3),6)
+        self.assertEqual(len(calls),1)
+
+    def test_recycling(self):
+        f = Future.get_or_create()
+        generation = f.generation
+        f.set_result(1)
+        f.recycle()
+        self.assertRaises(Call.StaleFutureError,f.result)
+        self.assertRaises(Call.StaleFutureError,f.recycle)
+        self.assertRaises(Call.StaleFutureError,f.check_generation,generation)
+        f2 = Future.get_or_create()
+        self.assertTrue(f2 is f)
+        self.assertFalse(f2.done())
+        self.assertRaises(Call.StaleFutureError,f.call_function_if_current,
+                                                generation,int,"1")
+        self.assertFalse(f2.done())
+
+    def test_recycling_from_many_threads(self):
+        errors = []
+        def worker():
+            try:
+                for i in xrange(1000):
+                    f = Future.get_or_create()
+                    f.set_result(i)
+                    assert f.result() == i
+                    f.recycle()
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=worker) for _ in xrange(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals(errors,[])
+        self.assertTrue(len(Future._FREE_LIST) <= Future._FREE_LIST.maxlen)
+
+
+class TestCallCollapsers(unittest.TestCase):
+
+    def setUp(self):
+        self.app = get_app()
+        Call.qCallAfter(lambda: None)
+        process_events_until(lambda: not Call.qCallAfter._hasCalls())
+
+    def _call_from_thread(self,func,args_list,delay=0):
+        def producer():
+            for args in args_list:
+                func(*args)
+                time.sleep(delay)
+        t = threading.Thread(target=producer)
+        t.start()
+        return t
+
+    def test_qCoalesce(self):
+        output = []
+        @qCallUsing(qCoalesce(key=lambda name,value: name))
+        def update(name,value):
+            output.append((name,value))
+        t = self._call_from_thread(update,[("a",i) for i in xrange(100)])
+        t.join()
+        update("b",1)
+        process_events_until(lambda: len(output) == 2)
+        self.assertEquals(output,[("a",99),("b",1)])
+
+    def test_qDebounce(self):
+        output = []
+        @qCallUsing(qDebounce(0.05))
+        def search(text):
+            output.append(text)
+        t = self._call_from_thread(search,[("a",),("ab",),("abc",)],0.01)
+        process_events_until(lambda: output)
+        t.join()
+        self.assertEquals(output,["abc"])
+
+    def test_qThrottle(self):
+        output = []
+        @qCallUsing(qThrottle(20))
+        def status(i):
+            output.append(i)
+        start = time.time()
+        t = self._call_from_thread(status,[(i,) for i in xrange(50)],0.002)
+        t.join()
+        process_events_until(lambda: 49 in output)
+        elapsed = time.time() - start
+        self.assertTrue(len(output) <= int(elapsed * 20) + 2)
+        self.assertEquals(output[-1],49)
+        self.assertEquals(output,sorted(output))
+
+    def test_qCached(self):
+        calls = []
+        release = threading.Event()
+        cache = qCached(maxsize=2)
+        @qCallUsing(cache)
+        def compute(x):
+            release.wait(5)
+            calls.append(x)
+            return x * x
+        futures = [compute(3) for _ in xrange(5)]
+        self.assertTrue(all(f is futures[0] for f in futures))
+        release.set()
+        self.assertEqual(futures[0].get_result(5),9)
+        self.assertTrue(compute(3) is futures[0])
+        self.assertEqual(compute(4).get_result(5),16)
+        self.assertEqual(compute(5).get_result(5),25)
+        self.assertEqual(compute(3).get_result(5),9)
+        self.assertEqual(calls,[3,4,5,3])
+        self.assertEqual(compute(5).get_result(5),25)
+        self.assertEqual(calls,[3,4,5,3])
+        self.assertEqual(cache.stats()["collapsed"],4)
+        self.assertEqual(cache.stats()["evictions"],2)
+
+    def test_qCached_stats_and_expiry(self):
+        cache = qCached(ttl=0.05)
+        def fail(x):
+            raise ValueError(x)
+        self.assertEqual(cache(square,2).get_result(5),4)
+        self.assertEqual(cache(square,2).get_result(5),4)
+        self.assertRaises(ValueError,cache(fail,2).get_result,5)
+        self.assertRaises(ValueError,cache(fail,2).get_result,5)
+        time.sleep(0.1)
+        self.assertEqual(cache(square,2).get_result(5),4)
+        stats = cache.stats()
+        self.assertEqual(stats["hits"],1)
+        self.assertEqual(stats["misses"],4)
+        self.assertEqual(stats["expirations"],1)
+        self.assertEqual(stats["size"],1)
+        cache.clear()
+        self.assertEqual(cache.stats()["size"],0)
+
+
+class TestCallQueue(unittest.TestCase):
+
+    def _make_queue(self,policy):
+        q = Call._CallQueue(3)
+        q.overflow_policy = policy
+        return q
+
+    def _contents(self,q):
+        return [call[1] for call in q.queue]
+
+    def test_drop_policies(self):
+        q = self._make_queue(Call.OVERFLOW_DROP_OLDEST)
+        for i in xrange(5):
+            q.put_call((None,i,None))
+        self.assertEquals(self._contents(q),[2,3,4])
+        self.assertEquals(q.num_dropped,2)
+        q = self._make_queue(Call.OVERFLOW_DROP_NEWEST)
+        for i in xrange(5):
+            q.put_call((None,i,None))
+        self.assertEquals(self._contents(q),[0,1,2])
+        self.assertEquals(q.num_dropped,2)
+
+    def test_coalesce_policy(self):
+        q = self._make_queue(Call.OVERFLOW_COALESCE)
+        q.coalesce_key = lambda call: call[0]
+        for (func,arg) in [("a",1),("b",1),("c",1),("b",2),("d",1)]:
+            q.put_call((func,arg,None))
+        self.assertEquals(list(q.queue),[("b",2,None),("c",1,None),
+                                         ("d",1,None)])
+        self.assertEquals(q.num_coalesced,1)
+        self.assertEquals(q.num_dropped,1)
+        #  By default, only calls with the same arguments are coalesced.
+        q = self._make_queue(Call.OVERFLOW_COALESCE)
+        for (func,arg) in [("a",1),("b",1),("c",1),("b",2),("c",1)]:
+            q.put_call((func,arg,None))
+        self.assertEqual(list(q.queue),[("b",1,None),("c",1,None),
+                                         ("b",2,None)])
+        self.assertEqual(q.num_coalesced,1)
+        self.assertEqual(q.num_dropped,1)
+
+    def test_exempt_calls(self):
+        #  Exempt calls never block, even outside the main thread.
+        q = self._make_queue(Call.OVERFLOW_BLOCK)
+        for i in xrange(5):
+            q.put_call(("a",i,None),exempt=True)
+        self.assertEqual(self._contents(q),range(5))
+        self.assertEqual(q.num_blocked,0)
+        for policy in (Call.OVERFLOW_DROP_OLDEST,Call.OVERFLOW_DROP_NEWEST,
+                       Call.OVERFLOW_COALESCE):
+            q = self._make_queue(policy)
+            q.put_call(("a",0,None),exempt=True)
+            q.put_call(("a",1,None))
+            q.put_call(("a",2,None))
+            q.put_call(("a",3,None),exempt=True)
+            self.assertEqual(self._contents(q),[0,1,2,3])
+            #  Exempt calls are never dropped or replaced.
+            q.put_call(("a",0,None))
+            q.put_call(("a",3,None))
+            self.assertTrue(0 in self._contents(q))
+            self.assertTrue(3 in self._contents(q))
+
+    def test_block_policy(self):
+        q = self._make_queue(Call.OVERFLOW_BLOCK)
+        def producer():
+            for i in xrange(5):
+                q.put_call((None,i,None))
+        t = threading.Thread(target=producer)
+        t.start()
+        output = []
+        while len(output) < 5:
+            time.sleep(0.01)
+            self.assertTrue(q.qsize() <= 3)
+            output.append(q.get()[1])
+        t.join()
+        self.assertEquals(output,range(5))
+        self.assertTrue(q.num_blocked > 0)
+
+    def test_qCallAfter_backpressure(self):
+        get_app()
+        Call.qCallAfter(lambda: None)
+        process_events_until(lambda: not Call.qCallAfter._hasCalls())
+        Call.qCallAfter.configure(max_pending=10,
+                                  overflow_policy=Call.OVERFLOW_DROP_OLDEST)
+        try:
+            stats = Call.qCallAfter.stats()
+            output = []
+            for i in xrange(20):
+                Call.qCallAfter(output.append,i)
+            process_events_until(lambda: 19 in output)
+            self.assertEquals(output,range(10,20))
+            self.assertEquals(Call.qCallAfter.stats()["dropped"],
+                              stats["dropped"] + 10)
+        finally:
+            Call.qCallAfter.configure(max_pending=0,
+                                      overflow_policy=Call.OVERFLOW_BLOCK)
+
+
+    def test_qCallInMainThread_with_full_queue(self):
+        get_app()
+        Call.qCallAfter(lambda: None)
+        process_events_until(lambda: not Call.qCallAfter._hasCalls())
+        Call.qCallAfter.configure(max_pending=1,
+                                  overflow_policy=Call.OVERFLOW_DROP_NEWEST)
+        try:
+            Call.qCallAfter(lambda: None)
+            results = []
+            def worker():
+                results.append(qCallInMainThread(square,3))
+            t = threading.Thread(target=worker)
+            t.daemon = True
+            t.start()
+            process_events_until(lambda: results)
+            t.join(5)
+            self.assertEqual(results,[9])
+        finally:
+            Call.qCallAfter.configure(max_pending=0,
+                                      overflow_policy=Call.OVERFLOW_BLOCK)
+
+
+class TestWorkerProcesses(unittest.TestCase):
+
+    def test_qCallInWorkerProcess(self):
+        self.assertEqual(qCallInWorkerProcess(square,7).result(),49)
+        future = qCallInWorkerProcess(int,"oops")
+        self.assertRaises(ValueError,future.result)
+        self.assertTrue("Traceback" in future.exception().remote_traceback)
+        future = qCallInWorkerProcess(lambda: 42)
+        self.assertTrue(future.exception() is not None)
+        #  Results that can't be sent back are reported as errors.
+        future = qCallInWorkerProcess(make_lock)
+        self.assertTrue(future.exception(5) is not None)
+
+    def test_qMapInWorkerProcess(self):
+        future = qMapInWorkerProcess(square,xrange(100),chunksize=7)
+        self.assertEqual(future.result(),[i * i for i in xrange(100)])
+        self.assertEqual(qMapInWorkerProcess(square,[]).result(),[])
+        future = qMapInWorkerProcess(int,["1","2","oops","4"],chunksize=1)
+        self.assertRaises(ValueError,future.result)
+        future = qMapInWorkerProcess(make_lock,[1,2,3],chunksize=2)
+        self.assertTrue(future.exception(5) is not None)
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        self.app = get_app()
+        Call.qCallAfter(lambda: None)
+        process_events_until(lambda: not Call.qCallAfter._hasCalls())
+
+    def tearDown(self):
+        Call.qDisableInstrumentation()
+
+    def test_disabled_by_default(self):
+        self.assertEqual(Call.qGetCallStats(),{})
+
+    def test_histogram(self):
+        h = Call.Histogram()
+        for i in xrange(100):
+            h.add(i / 1000.0)
+        summary = h.summary()
+        self.assertEqual(summary["count"],100)
+        self.assertEqual(summary["min"],0)
+        self.assertEqual(summary["max"],0.099)
+        self.assertTrue(0.03 <= summary["p50"] <= 0.07)
+        self.assertTrue(summary["p99"] <= summary["max"])
+
+    def test_call_stats(self):
+        Call.qEnableInstrumentation()
+        output = []
+        for i in xrange(10):
+            Call.qCallAfter(output.append,i)
+        process_events_until(lambda: len(output) == 10)
+        qCallInWorkerThread(time.sleep,0.01).result()
+        stats = Call.qGetCallStats()
+        self.assertEqual(stats["qCallAfter"]["run"]["count"],10)
+        self.assertTrue(stats["qCallAfter"]["peak_depth"] >= 10)
+        pool_stats = stats["WorkerPool:None"]
+        self.assertEqual(pool_stats["run"]["count"],1)
+        self.assertTrue(pool_stats["run"]["max"] >= 0.01)
+        self.assertTrue(pool_stats["peak_busy_workers"] >= 1)
+        self.assertTrue(0 <= pool_stats["utilization"] <= 1)
+
+    def test_slow_calls_are_logged(self):
+        messages = []
+        instrumentation = Call.qEnableInstrumentation(threshold=0.005)
+        instrumentation.logger = FakeLogger(messages)
+        Call.qCallAfter(time.sleep,0.01)
+        process_events_until(lambda: messages)
+        self.assertEqual(len(messages),1)
+        self.assertTrue("sleep" in messages[0])
+
+
+class TestTracing(unittest.TestCase):
+
+    def setUp(self):
+        self.app = get_app()
+        Call.qCallAfter(lambda: None)
+        process_events_until(lambda: not Call.qCallAfter._hasCalls())
+
+    def tearDown(self):
+        Call.qDisableTracing()
+        Call.qDisableInstrumentation()
+
+    def test_trace_events(self):
+        self.assertRaises(RuntimeError,Call.qDumpTrace,StringIO.StringIO())
+        Call.qEnableInstrumentation()
+        Call.qEnableTracing()
+        def worker():
+            return qCallInMainThread(square,3)
+        qCallInWorkerThread(worker)
+        called = []
+        qCallLater(0.01,called.append,True)
+        process_events_until(lambda: called)
+        f = StringIO.StringIO()
+        Call.qDumpTrace(f)
+        events = json.loads(f.getvalue())["traceEvents"]
+        cats = set(e.get("cat") for e in events)
+        for cat in ("qCallAfter","qCallInMainThread","qCallLater",
+                    "WorkerPool:None"):
+            self.assertTrue(cat in cats,cat)
+        #  Each flow start is matched by a flow end on the executing thread.
+        starts = dict((e["id"],e) for e in events if e["ph"] == "s")
+        ends = dict((e["id"],e) for e in events if e["ph"] == "f")
+        self.assertEqual(set(starts),set(ends))
+        main_tid = [e["tid"] for e in events if e["ph"] == "X" and
+                    e["name"] == "square"][0]
+        for (id,start) in starts.iteritems():
+            if start["name"] == "square":
+                self.assertNotEqual(start["tid"],main_tid)
+                self.assertEqual(ends[id]["tid"],main_tid)
+        names = [e for e in events if e["ph"] == "M"]
+        self.assertTrue(len(names) >= 2)
+
+    def test_ring_buffer(self):
+        tracer = Call.qEnableTracing(max_events=10)
+        output = []
+        for i in xrange(20):
+            Call.qCallAfter(output.append,i)
+        process_events_until(lambda: len(output) == 20)
+        self.assertEqual(len(tracer._events),10)
+        tracer.clear()
+        self.assertEqual([e for e in tracer.events() if e["ph"] != "M"],[])
+
+
+class FakeLogger(object):
+
+    def __init__(self,messages):
+        self.messages = messages
+
+    def warning(self,msg,*args):
+        self.messages.append(msg % args)
+
+    exception = warning
+
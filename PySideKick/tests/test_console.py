@@ -0,0 +1,131 @@
+
+import unittest
+
+import time
+import threading
+
+import PySideKick
+from PySideKick import QtCore
+from PySideKick import Call
+from PySideKick.Call import WorkerPool
+from PySideKick.Console import _QPythonConsoleOutput
+from PySideKick.Console import _QPythonConsoleInterpreter
+
+
+def get_app():
+    app = QtCore.QCoreApplication.instance()
+    if app is None:
+        app = QtCore.QCoreApplication([])
+    return app
+
+
+def process_events_until(predicate,timeout=5):
+    end = time.time() + timeout
+    while not predicate() and time.time() < end:
+        QtCore.QCoreApplication.processEvents()
+        time.sleep(0.001)
+    return predicate()
+
+
+class FakePlainTextEdit(object):
+    """Stand-in for QPlainTextEdit, recording the text appended to it."""
+
+    def __init__(self,max_blocks):
+        self.max_blocks = max_blocks
+        self.appended = []
+
+    def maximumBlockCount(self):
+        return self.max_blocks
+
+    def appendPlainText(self,text):
+        self.appended.append(text)
+
+    def lines(self):
+        return "\n".join(self.appended).split("\n")
+
+
+class TestConsoleOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.app = get_app()
+        Call.qCallAfter(lambda: None)
+
+    def test_output_is_batched(self):
+        output = FakePlainTextEdit(0)
+        buffer = _QPythonConsoleOutput(output)
+        for i in xrange(100):
+            buffer.write("line %d\n" % (i,))
+        self.assertEqual(output.appended,[])
+        process_events_until(lambda: output.appended)
+        self.assertEqual(len(output.appended),1)
+        expected = ["line %d" % (i,) for i in xrange(100)]
+        self.assertEqual(output.lines(),expected)
+
+    def test_flush_budget(self):
+        output = FakePlainTextEdit(0)
+        buffer = _QPythonConsoleOutput(output)
+        buffer.max_flush_bytes = 100
+        buffer.write("x" * 49 + "\n" + "y" * 49 + "\n" + "z" * 49)
+        process_events_until(lambda: len(output.appended) == 2)
+        expected = ["x" * 49 + "\n" + "y" * 49,"z" * 49]
+        self.assertEqual(output.appended,expected)
+
+    def test_output_is_trimmed(self):
+        output = FakePlainTextEdit(10)
+        buffer = _QPythonConsoleOutput(output)
+        buffer.write("\n".join(str(i) for i in xrange(100)))
+        buffer.flush()
+        self.assertEqual(output.lines(),[str(i) for i in xrange(90,100)])
+
+
+class FakeConsoleUI(object):
+
+    def __init__(self):
+        self.output = FakePlainTextEdit(0)
+        self.output_buffer = _QPythonConsoleOutput(self.output)
+
+
+class TestThreadedInterpreter(unittest.TestCase):
+
+    def setUp(self):
+        self.app = get_app()
+        Call.qCallAfter(lambda: None)
+        self.ui = FakeConsoleUI()
+        self.interpreter = _QPythonConsoleInterpreter(self.ui)
+        self.worker = WorkerPool(max_workers=1)
+
+    def tearDown(self):
+        self.worker.shutdown()
+
+    def push(self,line):
+        return self.worker.submit(self.interpreter.push_in_thread,line)
+
+    def get_output(self):
+        self.ui.output_buffer.flush()
+        return self.ui.output.lines()
+
+    def test_output_is_streamed(self):
+        self.assertFalse(self.push("import sys, time").result(5))
+        code = "for i in range(3): print(i); time.sleep(0.1)"
+        self.assertTrue(self.push(code).result(5))
+        future = self.push("")
+        #  Output arrives while the command is still running.
+        self.assertTrue(process_events_until(lambda: self.get_output()[-1]))
+        self.assertFalse(future.done())
+        self.assertFalse(future.result(5))
+        self.assertEqual(self.get_output(),["0","1","2"])
+        code = "sys.stdout.write('x\\n'); sys.stderr.write('y\\nz')"
+        self.assertFalse(self.push(code).result(5))
+        self.assertEqual(self.get_output(),["0","1","2","x","y","z"])
+
+    def test_interrupt(self):
+        self.assertFalse(self.interpreter.interrupt())
+        self.push("while True:")
+        self.push("    pass")
+        future = self.push("")
+        self.assertTrue(process_events_until(self.interpreter.interrupt))
+        self.assertFalse(future.result(5))
+        self.assertTrue("KeyboardInterrupt" in self.get_output()[-1])
+        self.assertEqual(self.interpreter.thread_id,None)
+        self.assertFalse(self.push("x = 1").result(5))
+        self.assertEqual(self.interpreter.locals["x"],1)
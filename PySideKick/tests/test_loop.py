@@ -0,0 +1,76 @@
+
+import unittest
+
+import time
+import threading
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+import PySideKick
+from PySideKick import QtCore
+from PySideKick import Call
+
+
+def get_app():
+    app = QtCore.QCoreApplication.instance()
+    if app is None:
+        app = QtCore.QCoreApplication([])
+    return app
+
+
+@unittest.skipIf(asyncio is None,"asyncio is not available")
+class TestQAsyncioEventLoop(unittest.TestCase):
+
+    def setUp(self):
+        from PySideKick.Loop import QAsyncioEventLoop
+        self.app = get_app()
+        Call.qCallAfter(lambda: None)
+        self.loop = QAsyncioEventLoop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def test_call_soon_and_call_later(self):
+        output = []
+        self.loop.call_later(0.02,output.append,3)
+        self.loop.call_soon(output.append,1)
+        self.loop.call_later(0.01,output.append,2)
+        self.loop.call_later(0.01,output.append,"x").cancel()
+        self.loop.call_later(0.03,self.loop.stop)
+        self.loop.run_forever()
+        self.assertEqual(output,[1,2,3])
+
+    def test_sleep(self):
+        start = time.time()
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertTrue(time.time() - start >= 0.04)
+
+    def test_sockets(self):
+        import socket
+        (a,b) = socket.socketpair()
+        received = []
+        def on_readable():
+            received.append(b.recv(100))
+            self.loop.remove_reader(b)
+            self.loop.stop()
+        self.loop.add_reader(b,on_readable)
+        self.loop.call_soon(a.send,b"hello")
+        self.loop.run_forever()
+        self.assertEqual(received,[b"hello"])
+        a.close()
+        b.close()
+
+    def test_await_in_threads(self):
+        from PySideKick.Loop import qAwaitInWorkerThread, qAwaitInMainThread
+        current = threading.currentThread
+        future = asyncio.gather(qAwaitInWorkerThread(current),
+                                qAwaitInMainThread(current))
+        (worker,main) = self.loop.run_until_complete(future)
+        self.assertTrue(worker is not current())
+        self.assertTrue(main is current())
+
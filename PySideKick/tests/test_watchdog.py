@@ -0,0 +1,92 @@
+
+import unittest
+
+import time
+import thread
+import threading
+
+import PySideKick
+from PySideKick import QtCore
+from PySideKick import Call
+from PySideKick.Watchdog import StallWatchdog
+
+
+def get_app():
+    app = QtCore.QCoreApplication.instance()
+    if app is None:
+        app = QtCore.QCoreApplication([])
+    return app
+
+
+def process_events_until(predicate,timeout=5):
+    end = time.time() + timeout
+    while not predicate() and time.time() < end:
+        QtCore.QCoreApplication.processEvents()
+        time.sleep(0.001)
+    return predicate()
+
+
+class FakeLogger(object):
+
+    def __init__(self,messages):
+        self.messages = messages
+
+    def warning(self,msg,*args):
+        self.messages.append(msg % args)
+
+    exception = warning
+
+
+def block_main_thread(duration):
+    time.sleep(duration)
+
+
+class TestStallWatchdog(unittest.TestCase):
+
+    def setUp(self):
+        self.app = get_app()
+        Call.qCallAfter(lambda: None)
+        self.messages = []
+        self.stalls = []
+        self.watchdog = StallWatchdog(0.05,0.01,callback=self.stalls.append)
+        self.watchdog.logger = FakeLogger(self.messages)
+        self.watchdog.start()
+
+    def tearDown(self):
+        self.watchdog.stop()
+
+    def test_responsive_loop(self):
+        end = time.time() + 0.2
+        process_events_until(lambda: time.time() > end)
+        stats = self.watchdog.stats()
+        self.assertEqual(stats["stalls"],0)
+        self.assertTrue(stats["latency"]["count"] > 0)
+        self.assertEqual(self.messages,[])
+
+    def test_stall_is_reported(self):
+        process_events_until(lambda: self.watchdog.stats()["latency"]["count"])
+        block_main_thread(0.2)
+        process_events_until(lambda: self.stalls and
+                                     self.stalls[0].duration is not None)
+        self.assertEqual(len(self.stalls),1)
+        stall = self.stalls[0]
+        self.assertTrue(stall.duration >= 0.05)
+        self.assertTrue("in block_main_thread" in stall.location)
+        self.assertEqual(len(self.messages),1)
+        self.assertTrue("block_main_thread" in self.messages[0])
+        stats = self.watchdog.stats()
+        self.assertEqual(stats["stalls"],1)
+        self.assertEqual(stats["locations"],{stall.location:1})
+        self.assertEqual(stats["stall_time"],stall.duration)
+        self.assertEqual(len(stats["recent_stalls"]),1)
+
+    def test_main_thread_id(self):
+        self.assertEqual(self.watchdog.main_thread_id,thread.get_ident())
+        #  It can also be started from another thread once the app exists.
+        watchdog = StallWatchdog(0.05,0.01)
+        t = threading.Thread(target=watchdog.start)
+        t.start()
+        process_events_until(lambda: not t.isAlive())
+        watchdog.stop()
+        self.assertEqual(watchdog.main_thread_id,thread.get_ident())
+